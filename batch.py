@@ -0,0 +1,169 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import google_calendar_client as ggc
+from config import CONFIG_FILE, config_dict, load_config
+from ics_feed import write_feeds
+from leagues import ARENAS, build_registry, league_options
+from logger import Logger
+import metrics
+import parser as p
+from parser import Event, Window
+from pipeline import (
+    FetchJob,
+    enabled_leagues,
+    expire_rejected_events,
+    fetch_jobs,
+    league_timeout,
+    sync_window,
+    unfetched_tags,
+    upcoming_events,
+)
+import resilience
+
+logger = Logger(__name__)
+
+TENANT_WORKERS = 4
+
+JobKey = tuple[str, str, tuple]
+
+
+def load_tenant(path: str) -> dict[str, dict[str, str]]:
+    """
+    Returns urls.ini of the tenant directory as plain dicts.
+    """
+    return config_dict(load_config(os.path.join(path, CONFIG_FILE)))
+
+
+def job_key(config: dict[str, dict[str, str]], league: str) -> JobKey:
+    """
+    Returns what a parse of the league depends on: its url and parser options with arena aliases.
+    Tenants with the same key share one fetch and parse.
+    """
+    options = league_options(config, league)
+    arenas = {**ARENAS, **config.get("arenas", {})}
+    return (
+        config["league_urls"][league],
+        league,
+        (tuple(sorted(options.items())), tuple(sorted(arenas.items()))),
+    )
+
+
+def tenant_jobs(
+    configs: dict[str, dict[str, dict[str, str]]],
+) -> tuple[dict[JobKey, FetchJob], dict[str, list[JobKey]]]:
+    """
+    Collects the leagues of all tenants into fetch jobs, one per distinct url and parser.
+
+    Returns:
+        tuple: jobs by key and keys of the jobs of every tenant
+    """
+    jobs = {}
+    keys = {}
+    for name, config in configs.items():
+        registry = build_registry(config)
+        keys[name] = []
+        for league in enabled_leagues(config):
+            if league not in registry or league not in config.get("league_urls", {}):
+                logger.warning(
+                    f"{name}: league {league} has no parser or url, skipping"
+                )
+                continue
+            key = job_key(config, league)
+            timeout = league_timeout(config, league)
+            job = jobs.get(key)
+            if job is None or job.timeout < timeout:
+                jobs[key] = FetchJob(league, key[0], registry[league], timeout)
+            keys[name].append(key)
+    return jobs, keys
+
+
+def shared_window(windows: list[Window], now: datetime) -> Window:
+    """
+    Returns the window covering the windows of all tenants, open-ended if any of them is.
+    """
+    ends = [window.end for window in windows]
+    if not ends or None in ends:
+        return Window(now)
+    return Window(now, max(ends))
+
+
+def sync_tenant(
+    path: str,
+    events: list[Event],
+    time_max: datetime | None = None,
+    unfetched: set[str] | None = None,
+):
+    """
+    Writes the feeds and syncs the calendars of the tenant from the shared events,
+    keeping the games of the unfetched leagues.
+
+    Runs in a process of its own inside the tenant directory, so urls.ini, token.json,
+    state.db and the caches of the modules are the tenant's own.
+    """
+    os.chdir(path)
+    os.makedirs("Logs", exist_ok=True)
+    metrics.start_run(f"batch {path}")
+    try:
+        config = config_dict()
+        resilience.start_run_deadline(config)
+        expire_rejected_events(config)
+        write_feeds(config, events, unfetched)
+        if config.get("cals"):
+            service = ggc.get_calendar_service()
+            ggc.refresh_calendar(service, config["cals"], events, time_max, unfetched)
+    finally:
+        resilience.start_deadline(None)
+        metrics.finish_run()
+
+
+def run_batch(paths: list[str], workers: int = TENANT_WORKERS):
+    """
+    Syncs every tenant directory, each with its own urls.ini, credentials and state.
+
+    Every distinct league page is fetched and parsed once for all tenants, with the state of
+    the current directory as the page cache, then each tenant gets the games of its leagues
+    within its window and syncs them in a pool of worker processes.
+    """
+    paths = [os.path.abspath(path) for path in paths]
+    configs = {path: load_tenant(path) for path in paths}
+    now = datetime.now(p.MINSK_TZ)
+    windows = {path: sync_window(config, now) for path, config in configs.items()}
+
+    metrics.start_run("batch")
+    resilience.start_deadline()
+    try:
+        jobs, keys = tenant_jobs(configs)
+        logger.info(
+            f"Fetching {len(jobs)} pages for {len(paths)} tenants "
+            f"instead of {sum(len(tenant_keys) for tenant_keys in keys.values())}"
+        )
+        results = fetch_jobs(jobs, shared_window(list(windows.values()), now))
+    finally:
+        resilience.start_deadline(None)
+        metrics.finish_run()
+
+    # a new process for every tenant, module globals like credentials and the store are never shared
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(paths)) or 1, max_tasks_per_child=1
+    ) as pool:
+        futures = {}
+        for path in paths:
+            window = windows[path]
+            tenant_keys = dict.fromkeys(keys[path])
+            events = upcoming_events(
+                [event for key in tenant_keys for event in results[key] or []],
+                now,
+            )
+            futures[path] = pool.submit(
+                sync_tenant,
+                path,
+                [event for event in events if not window.after(event.start)],
+                window.end,
+                unfetched_tags(jobs, {key: results[key] for key in tenant_keys}),
+            )
+        for path, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Couldn't sync {path}: {e}", exc_info=True)
@@ -0,0 +1,360 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.fake_calendar import FakeCalendar  # noqa: E402
+from benchmarks.fake_telegram import FakeTelegram  # noqa: E402
+from benchmarks.pages import (  # noqa: E402
+    BASE_GAMES,
+    LeagueSites,
+    cancel,
+    record_page,
+    recorded_page,
+    render,
+    reschedule,
+    season,
+)
+
+LEAGUES = ("nhl", "lhl", "alh")
+# synthetic seasons run from mid August to the end of the year, so pages without years stay in one
+SEASON_START = (8, 18)
+SEASON_DAYS = 135
+# the window of the parse benchmarks opens two weeks into the season
+SEASON_TODAY = (9, 1)
+SYNC_DAYS = 60
+SYNC_HORIZON = 14
+
+
+def best_of(repeat: int, func):
+    """
+    Runs func repeat times and returns the fastest time in seconds with the last result.
+    """
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def enter_workdir() -> str:
+    """
+    Moves into a fresh directory, so the runs get their own urls.ini, state.db and Logs.
+    """
+    workdir = tempfile.mkdtemp(prefix="hockey-bench-")
+    os.chdir(workdir)
+    os.makedirs("Logs")
+    return workdir
+
+
+def write_config(sites: LeagueSites):
+    with open("urls.ini", "w", encoding="utf-8") as f:
+        f.write(
+            "[league_urls]\n"
+            + "".join(f"{league} = {sites.url(league)}\n" for league in LEAGUES)
+            + f"[sync]\nleagues = {','.join(LEAGUES)}\nhorizon_days = {SYNC_HORIZON}\n"
+            "[cals]\npersonal = Hockey\ncommon = Common\n"
+            f"[calendar_leagues]\npersonal = {','.join(LEAGUES)}\ncommon = lhl\n"
+            "[telegram]\ntoken = bench\npersonal_chat_id = 1\nnotify_list = 2,3\n"
+            "lhl_sec_chat_id = 4\n"
+        )
+
+
+def season_games(league: str, scale: int) -> list:
+    today = date.today()
+    start = date(today.year, *SEASON_START)
+    return season(
+        league,
+        BASE_GAMES[league] * scale,
+        start,
+        SEASON_DAYS,
+        date(today.year, *SEASON_TODAY),
+    )
+
+
+def season_window():
+    from parser import MINSK_TZ, Window
+
+    opens = datetime.combine(
+        date(date.today().year, *SEASON_TODAY), datetime.min.time()
+    )
+    return Window(MINSK_TZ.localize(opens))
+
+
+def bench_parse(scales: list[int], repeat: int) -> dict[str, float]:
+    """
+    Parses every league page whole and block by block, cold and after one game was moved.
+    """
+    from config import config_dict
+    from http_cache import BlockCache
+    from leagues import get_registry
+    from parser import MINSK_TZ, Window
+
+    registry = get_registry(config_dict())
+    metrics = {}
+    for league in LEAGUES:
+        parse = registry[league]
+        pages = []
+        recorded = recorded_page(league)
+        if recorded:
+            pages.append(("recorded", recorded, None, Window(datetime.now(MINSK_TZ))))
+        for scale in scales:
+            games = season_games(league, scale)
+            pages.append((f"{scale}x", render(league, games), games, season_window()))
+
+        for label, html, games, window in pages:
+            prefix = f"parse.{league}.{label}"
+            seconds, events = best_of(repeat, lambda: list(parse(html, window)))
+            metrics[f"{prefix}.kb"] = len(html.encode("utf-8")) / 1024
+            metrics[f"{prefix}.games"] = len(events)
+            metrics[f"{prefix}.full_ms"] = seconds * 1000
+            metrics[f"{prefix}.games_per_s"] = len(events) / seconds
+            metrics[f"{prefix}.mb_per_s"] = metrics[f"{prefix}.kb"] / 1024 / seconds
+            if parse.block_re is None:
+                continue
+            seconds, _ = best_of(
+                repeat, lambda: list(parse(html, window, BlockCache(league)))
+            )
+            metrics[f"{prefix}.blocks_cold_ms"] = seconds * 1000
+            if games is None:
+                continue
+            warm = BlockCache(league)
+            list(parse(html, window, warm))
+            changed = render(league, reschedule(games))
+            seconds, _ = best_of(
+                repeat,
+                lambda: list(parse(changed, window, BlockCache(league, warm.current))),
+            )
+            metrics[f"{prefix}.blocks_changed_ms"] = seconds * 1000
+    return metrics
+
+
+def bench_diff(scales: list[int], repeat: int) -> dict[str, float]:
+    """
+    Diffs every league page against a calendar in which one game in a hundred is somewhere else.
+    """
+    from config import config_dict
+    from leagues import get_registry
+    from sync_plan import build_plan
+
+    registry = get_registry(config_dict())
+    window = season_window()
+    metrics = {}
+    for scale in scales:
+        parsed = []
+        calendar = {}
+        for league in LEAGUES:
+            games = season_games(league, scale)
+            parsed.extend(registry[league](render(league, games), window))
+            stale = games
+            for index in range(0, len(games), 100):
+                if not games[index].played:
+                    stale = reschedule(stale, index)
+            stale = cancel(stale)
+            for event in registry[league](render(league, stale), window):
+                calendar[event] = f"event{len(calendar)}"
+        tags = {registry[league].tag for league in LEAGUES}
+        seconds, plan = best_of(
+            repeat, lambda: build_plan(parsed, calendar, set(), tags)
+        )
+        prefix = f"diff.{scale}x"
+        metrics[f"{prefix}.events"] = len(parsed)
+        metrics[f"{prefix}.ms"] = seconds * 1000
+        metrics[f"{prefix}.insert"] = len(plan.to_insert)
+        metrics[f"{prefix}.delete"] = len(plan.to_delete)
+        metrics[f"{prefix}.move"] = len(plan.to_move)
+    return metrics
+
+
+def bench_sync(
+    sites: LeagueSites, calendar: FakeCalendar, telegram: FakeTelegram, scale: int
+) -> dict[str, float]:
+    """
+    Runs main.run_once against the local sites, calendar and bot: the first run prompts for every game,
+    the second inserts the confirmed ones, the third finds nothing new and the last one syncs
+    a rescheduled and a cancelled game of every league.
+    """
+    import google_calendar_client
+    import main
+    import telegram_notifications
+    from metrics import RUNS_FILE
+
+    google_calendar_client.get_calendar_service = calendar.service
+    telegram_notifications.API_ROOT = telegram.root
+    # the per-chat interval is Telegram's flood policy, not work of the sync, and the local bot has none
+    telegram_notifications.CHAT_INTERVAL = 0.0
+
+    today = date.today()
+    games = {
+        league: season(
+            league,
+            BASE_GAMES[league] * scale * SYNC_DAYS // SEASON_DAYS,
+            today - timedelta(days=14),
+            SYNC_DAYS,
+            today,
+        )
+        for league in LEAGUES
+    }
+
+    def publish():
+        for league, league_games in games.items():
+            sites.pages[league] = render(league, league_games)
+
+    def change():
+        # games a few days ahead, well within the sync horizon
+        soon = today + timedelta(days=3)
+        for league, league_games in games.items():
+            index = next(i for i, game in enumerate(league_games) if game.day >= soon)
+            games[league] = cancel(reschedule(league_games, index), index + 1)
+        publish()
+
+    metrics = {}
+    for step, before in (
+        ("first", publish),
+        ("confirmed", None),
+        ("unchanged", None),
+        ("rescheduled", change),
+    ):
+        if before:
+            before()
+        for counters in (sites, calendar, telegram):
+            counters.reset_counters()
+        started = time.perf_counter()
+        main.run_once()
+        prefix = f"sync.{step}"
+        metrics[f"{prefix}.ms"] = (time.perf_counter() - started) * 1000
+        metrics[f"{prefix}.pages_200"] = sites.requests[200]
+        metrics[f"{prefix}.pages_304"] = sites.requests[304]
+        metrics[f"{prefix}.page_kb"] = sites.bytes / 1024
+        metrics[f"{prefix}.calendar_http"] = calendar.http_requests
+        for call, count in sorted(calendar.calls.items()):
+            metrics[f"{prefix}.calendar.{call}"] = count
+        for call, count in sorted(telegram.calls.items()):
+            metrics[f"{prefix}.telegram.{call}"] = count
+        # stage timings from the record the run appended to Logs/runs.jsonl
+        with open(RUNS_FILE, "r", encoding="utf-8") as f:
+            record = json.loads(f.readlines()[-1])
+        for name, stage in record["spans"].items():
+            metrics[f"{prefix}.span.{name}_ms"] = stage["seconds"] * 1000
+    for name, count in calendar.event_count().items():
+        metrics[f"sync.events.{name}"] = count
+    return metrics
+
+
+def record_pages():
+    """
+    Saves the live pages of urls.ini in the repo to benchmarks/recorded for replays.
+    """
+    from config import load_config
+    from parser import fetch_html
+
+    config = load_config(os.path.join(REPO_ROOT, "urls.ini"))
+    for league in LEAGUES:
+        url = config.get("league_urls", league, fallback=None)
+        html = fetch_html(url) if url else None
+        if html:
+            record_page(league, html)
+            print(f"recorded {league}: {len(html) // 1024} KB")
+        else:
+            print(f"couldn't record {league}")
+
+
+def print_metrics(metrics: dict[str, float], baseline: dict[str, float] | None):
+    width = max(len(name) for name in metrics)
+    for name, value in metrics.items():
+        line = f"{name:<{width}}  {value:>12.2f}"
+        old = (baseline or {}).get(name)
+        if old:
+            line += f"  {old:>12.2f}  {(value - old) / old * 100:+7.1f}%"
+        print(line)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Measures parsing, diffing and syncing against local stand-ins of the league sites, "
+        "Google Calendar and Telegram, without network.",
+    )
+    arg_parser.add_argument(
+        "--scales",
+        default="1,10,100",
+        help="comma separated sizes of the synthetic pages, 1 is a real season",
+    )
+    arg_parser.add_argument(
+        "--sync-scale", type=int, default=1, help="size of the pages of the sync runs"
+    )
+    arg_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="runs of every parse and diff, the fastest counts",
+    )
+    arg_parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.05,
+        help="seconds every request to the stand-ins waits, a round trip to the real services",
+    )
+    arg_parser.add_argument(
+        "--only", choices=("parse", "diff", "sync"), help="run a single benchmark"
+    )
+    arg_parser.add_argument("--save", help="write the results to a JSON file")
+    arg_parser.add_argument(
+        "--baseline", help="JSON file of earlier results to compare with"
+    )
+    arg_parser.add_argument(
+        "--record",
+        action="store_true",
+        help="save the live league pages for replays and exit, the only step using network",
+    )
+    arg_parser.add_argument("--verbose", action="store_true", help="show the logs")
+    args = arg_parser.parse_args()
+
+    scales = [int(scale) for scale in args.scales.split(",") if scale.strip()]
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+    save = os.path.abspath(args.save) if args.save else None
+
+    enter_workdir()
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+    if args.record:
+        record_pages()
+        return
+
+    sites = LeagueSites(args.latency)
+    calendar = FakeCalendar(["Hockey", "Common"], args.latency)
+    telegram = FakeTelegram(args.latency)
+    write_config(sites)
+
+    metrics = {}
+    try:
+        if args.only in (None, "parse"):
+            metrics.update(bench_parse(scales, args.repeat))
+        if args.only in (None, "diff"):
+            metrics.update(bench_diff(scales, args.repeat))
+        if args.only in (None, "sync"):
+            metrics.update(bench_sync(sites, calendar, telegram, args.sync_scale))
+    finally:
+        for server in (sites, calendar, telegram):
+            server.close()
+
+    print_metrics(metrics, baseline)
+    if save:
+        with open(save, "w") as f:
+            json.dump(metrics, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+import http.server
+import itertools
+import json
+import threading
+import time
+import uuid
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qs, unquote, urlsplit
+
+DISCOVERY_PATH = "/discovery/v1/apis/{api}/{apiVersion}/rest"
+
+
+class FakeCalendar:
+    """
+    Local stand-in for the Google Calendar API v3.
+
+    Serves the discovery document of the API pointed at itself, so the client is built the way
+    googleapiclient builds the real one, and implements the calls the sync makes: calendar list,
+    event list with page and sync tokens, insert, patch, delete and the batch endpoint.
+    Every HTTP request waits delay seconds to stand in for the round trip to Google.
+    """
+
+    def __init__(self, calendars: list[str], delay: float = 0.0):
+        self.delay = delay
+        self.names = {name: f"{name.lower()}@group.calendar" for name in calendars}
+        self.events: dict[str, dict[str, dict]] = {
+            calendar_id: {} for calendar_id in self.names.values()
+        }
+        # deleted events stay as cancelled and keep their ids taken, like in Google Calendar
+        self.cancelled: dict[str, dict[str, dict]] = {
+            calendar_id: {} for calendar_id in self.names.values()
+        }
+        # (seq, event, calendar id) of every change, sync tokens are positions in it
+        self.changes: list[tuple[int, dict, str]] = []
+        self.http_requests = 0
+        self.calls = Counter()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.root = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def service(self):
+        """
+        Builds a calendar service from the discovery document served by the fake.
+        """
+        from google.auth.credentials import AnonymousCredentials
+        from googleapiclient.discovery import build
+        from google_auth_httplib2 import AuthorizedHttp
+        from googleapiclient.http import build_http
+        from google_calendar_client import CountingHttp
+
+        return build(
+            "calendar",
+            "v3",
+            http=CountingHttp(
+                AuthorizedHttp(AnonymousCredentials(), http=build_http())
+            ),
+            discoveryServiceUrl=self.root.rstrip("/") + DISCOVERY_PATH,
+            static_discovery=False,
+            cache_discovery=False,
+        )
+
+    def reset_counters(self):
+        with self._lock:
+            self.http_requests = 0
+            self.calls.clear()
+
+    def event_count(self) -> dict[str, int]:
+        return {name: len(self.events[cid]) for name, cid in self.names.items()}
+
+    def discovery_document(self) -> dict:
+        from googleapiclient.discovery_cache import get_static_doc
+
+        document = json.loads(get_static_doc("calendar", "v3"))
+        document["rootUrl"] = self.root
+        document["baseUrl"] = self.root + document["servicePath"]
+        return document
+
+    def _log(self, event: dict, calendar_id: str):
+        self.changes.append((len(self.changes) + 1, dict(event), calendar_id))
+
+    def handle(self, method: str, path: str, query: dict, body: bytes):
+        """
+        Runs one API call.
+
+        Returns:
+            tuple[int, dict | None]: status and JSON body of the response
+        """
+        parts = [unquote(part) for part in path.strip("/").split("/")]
+        if parts[:2] == ["calendar", "v3"]:
+            parts = parts[2:]
+        query = {key: values[0] for key, values in query.items()}
+        with self._lock:
+            if parts == ["users", "me", "calendarList"]:
+                self.calls["calendarList.list"] += 1
+                items = [
+                    {"id": cid, "summary": name} for name, cid in self.names.items()
+                ]
+                return 200, {"items": items}
+            if len(parts) < 3 or parts[0] != "calendars" or parts[2] != "events":
+                return 404, {"error": {"code": 404, "message": "Not Found"}}
+            calendar_id = parts[1]
+            events = self.events.get(calendar_id)
+            if events is None:
+                return 404, {"error": {"code": 404, "message": "Not Found"}}
+            if len(parts) == 3 and method == "GET":
+                self.calls["events.list"] += 1
+                return 200, self._list(calendar_id, events, query)
+            if len(parts) == 3 and method == "POST":
+                self.calls["events.insert"] += 1
+                event = json.loads(body)
+                event.setdefault("id", f"event{next(self._ids)}")
+                if event["id"] in events or event["id"] in self.cancelled[calendar_id]:
+                    return 409, {
+                        "error": {
+                            "code": 409,
+                            "message": "The requested identifier already exists.",
+                        }
+                    }
+                event["status"] = "confirmed"
+                events[event["id"]] = event
+                self._log(event, calendar_id)
+                return 200, event
+            event_id = parts[3]
+            self.calls[f"events.{method.lower()}"] += 1
+            if method in ("PATCH", "PUT") and event_id in self.cancelled[calendar_id]:
+                update = json.loads(body)
+                if update.get("status") == "confirmed":
+                    events[event_id] = self.cancelled[calendar_id].pop(event_id)
+            if event_id not in events:
+                return 404, {"error": {"code": 404, "message": "Not Found"}}
+            if method == "DELETE":
+                self.cancelled[calendar_id][event_id] = events.pop(event_id)
+                self._log({"id": event_id, "status": "cancelled"}, calendar_id)
+                return 204, None
+            if method in ("PATCH", "PUT"):
+                events[event_id].update(json.loads(body))
+                self._log(events[event_id], calendar_id)
+                return 200, events[event_id]
+            return 200, events[event_id]
+
+    def _list(self, calendar_id: str, events: dict[str, dict], query: dict) -> dict:
+        seq = len(self.changes)
+        if "syncToken" in query:
+            since = int(query["syncToken"])
+            changed = {}
+            for position, event, cid in self.changes[since:]:
+                if cid == calendar_id:
+                    changed[event["id"]] = event
+            return {"items": list(changed.values()), "nextSyncToken": str(seq)}
+        items = list(events.values())
+        size = int(query.get("maxResults", 250))
+        start = int(query.get("pageToken", 0))
+        response = {"items": items[start : start + size]}
+        if start + size < len(items):
+            response["nextPageToken"] = str(start + size)
+        else:
+            response["nextSyncToken"] = str(seq)
+        return response
+
+    def _batch(self, content_type: str, body: bytes) -> tuple[bytes, str]:
+        message = BytesParser(policy=HTTP).parsebytes(
+            b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+        )
+        boundary = f"batch_{uuid.uuid4().hex}"
+        out = []
+        for part in message.iter_parts():
+            content_id = part["Content-ID"].strip("<>")
+            raw = part.get_payload(decode=True)
+            separator = b"\r\n\r\n" if b"\r\n\r\n" in raw else b"\n\n"
+            head, _, part_body = raw.partition(separator)
+            method, url, _ = head.split(b"\n")[0].decode().strip().split(" ")
+            url = urlsplit(url)
+            status, obj = self.handle(method, url.path, parse_qs(url.query), part_body)
+            data = b"" if obj is None else json.dumps(obj).encode()
+            out.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode()
+                + data
+                + b"\r\n"
+            )
+        out.append(f"--{boundary}--\r\n".encode())
+        return b"".join(out), f"multipart/mixed; boundary={boundary}"
+
+    def _handler(self):
+        calendar = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _reply(self, status: int, data: bytes, content_type: str):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def handle_any(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                url = urlsplit(self.path)
+                if url.path.startswith("/discovery/"):
+                    data = json.dumps(calendar.discovery_document()).encode()
+                    self._reply(200, data, "application/json")
+                    return
+                with calendar._lock:
+                    calendar.http_requests += 1
+                time.sleep(calendar.delay)
+                if url.path.startswith("/batch"):
+                    with calendar._lock:
+                        calendar.calls["batch"] += 1
+                    data, content_type = calendar._batch(
+                        self.headers["Content-Type"], body
+                    )
+                    self._reply(200, data, content_type)
+                    return
+                status, obj = calendar.handle(
+                    self.command, url.path, parse_qs(url.query), body
+                )
+                data = b"" if obj is None else json.dumps(obj).encode()
+                self._reply(status, data, "application/json")
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_any
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
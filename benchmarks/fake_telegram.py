@@ -0,0 +1,94 @@
+import http.server
+import itertools
+import json
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs, urlsplit
+
+
+class FakeTelegram:
+    """
+    Local stand-in for the Telegram Bot API: sendMessage, editMessageText, answerCallbackQuery
+    and getUpdates. With auto_confirm every prompt with an inline keyboard gets a Yes press
+    right away, which the next sync picks up from getUpdates.
+    """
+
+    def __init__(self, delay: float = 0.0, auto_confirm: bool = True):
+        self.delay = delay
+        self.auto_confirm = auto_confirm
+        self.messages: list[dict] = []
+        self.updates: list[dict] = []
+        self.calls = Counter()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.root = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls.clear()
+
+    def handle(self, method: str, params: dict) -> dict:
+        with self._lock:
+            self.calls[method] += 1
+            if method == "sendMessage":
+                message = {
+                    "message_id": next(self._message_ids),
+                    "chat": {"id": params.get("chat_id")},
+                    "text": params.get("text"),
+                }
+                self.messages.append(message)
+                if self.auto_confirm and params.get("reply_markup"):
+                    self.updates.append(
+                        {
+                            "update_id": next(self._update_ids),
+                            "callback_query": {
+                                "id": str(message["message_id"]),
+                                "data": "confirm_yes",
+                                "message": message,
+                            },
+                        }
+                    )
+                return {"ok": True, "result": message}
+            if method == "getUpdates":
+                offset = int(params.get("offset") or 0)
+                return {
+                    "ok": True,
+                    "result": [u for u in self.updates if u["update_id"] >= offset],
+                }
+            return {"ok": True, "result": True}
+
+    def _handler(self):
+        telegram = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def handle_any(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                params = json.loads(self.rfile.read(length) or b"{}") if length else {}
+                url = urlsplit(self.path)
+                params.update({k: v[0] for k, v in parse_qs(url.query).items()})
+                time.sleep(telegram.delay)
+                data = json.dumps(
+                    telegram.handle(url.path.rsplit("/", 1)[-1], params)
+                ).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = handle_any
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,256 @@
+import hashlib
+import http.server
+import os
+import random
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, replace
+from datetime import date, timedelta
+
+RECORDED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recorded")
+
+MONTHS = [
+    "января",
+    "февраля",
+    "марта",
+    "апреля",
+    "мая",
+    "июня",
+    "июля",
+    "августа",
+    "сентября",
+    "октября",
+    "ноября",
+    "декабря",
+]
+WEEKDAYS = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
+# known arenas of leagues.ARENAS and one the aliases miss
+ARENAS = [
+    'Крытый каток ГУ ХК "Юность-Минск"',
+    "Чижовка-Арена",
+    "Олимпик Арена",
+    "Крытый Ледовый Каток Раубичи",
+    "Ледовая арена Уручье",
+]
+TIMES = ["18:00", "19:15", "20:30", "21:45", "23:00"]
+
+# games of a 1x page, about as many as a real season page holds
+BASE_GAMES = {"nhl": 160, "lhl": 120, "alh": 120}
+# navigation, scripts and footers around the schedule of a real page
+CHROME = "".join(
+    f'<li class="menu__item"><a href="/section/{i}">Раздел {i}</a></li>'
+    for i in range(400)
+)
+
+
+@dataclass(frozen=True)
+class Game:
+    day: date
+    time: str
+    arena: str
+    team1: str
+    team2: str
+    played: bool = False
+
+
+def season(
+    league: str, games: int, start: date, days: int, today: date, seed: int = 0
+) -> list[Game]:
+    """
+    Returns games spread evenly over the days from start, games before today have a score.
+    """
+    rng = random.Random(f"{league}:{seed}")
+    teams = [f"{league.upper()} Команда {i}" for i in range(1, 25)]
+    result = []
+    for i in range(games):
+        day = start + timedelta(days=i * days // games)
+        team1, team2 = rng.sample(teams, 2)
+        result.append(
+            Game(
+                day,
+                TIMES[i % len(TIMES)],
+                rng.choice(ARENAS),
+                team1,
+                team2,
+                played=day < today,
+            )
+        )
+    return result
+
+
+def reschedule(games: list[Game], index: int | None = None) -> list[Game]:
+    """
+    Returns the games with one of them moved to another arena and an hour later,
+    the one in the middle of the upcoming games by default.
+    """
+    upcoming = [i for i, game in enumerate(games) if not game.played]
+    i = upcoming[len(upcoming) // 2] if index is None else index
+    game = games[i]
+    moved = replace(
+        game,
+        time=f"{int(game.time[:2]) + 1:02d}{game.time[2:]}",
+        arena=ARENAS[(ARENAS.index(game.arena) + 1) % len(ARENAS)],
+    )
+    return games[:i] + [moved] + games[i + 1 :]
+
+
+def cancel(games: list[Game], index: int | None = None) -> list[Game]:
+    """
+    Returns the games without one of them, the last upcoming one by default.
+    """
+    if index is None:
+        index = [i for i, game in enumerate(games) if not game.played][-1]
+    return games[:index] + games[index + 1 :]
+
+
+def _score(game: Game, rng: random.Random) -> str:
+    return f"{rng.randint(0, 7)} - {rng.randint(0, 7)}" if game.played else "- : -"
+
+
+def render_nhl(games: list[Game]) -> str:
+    rng = random.Random(0)
+    days: dict[date, list[Game]] = {}
+    for game in games:
+        days.setdefault(game.day, []).append(game)
+    out = [f'<html><body><ul class="menu">{CHROME}</ul><div class="timetable">']
+    for day, day_games in days.items():
+        # played days are hidden on the site
+        hidden = ' style="display: none;"' if all(g.played for g in day_games) else ""
+        out.append(
+            f'<div class="timetable__unit js-schedule-games-cont"{hidden}>'
+            f'<div class="timetable__date"><span>{day.day} {MONTHS[day.month - 1]}</span></div><ul>'
+        )
+        for game in day_games:
+            out.append(
+                f'<li class="timetable__item"><div class="timetable__score-main">{_score(game, rng)}</div>'
+                f'<span class="timetable__time">{game.time}</span>'
+                f'<span class="timetable__place-name">{game.arena}</span>'
+                f'<div class="timetable__middle"><div class="timetable__team-name">{game.team1}</div>'
+                f'<div class="timetable__team-name">{game.team2}</div></div></li>'
+            )
+        out.append("</ul></div>")
+    out.append(f'</div><ul class="footer">{CHROME}</ul></body></html>')
+    return "".join(out)
+
+
+def render_lhl(games: list[Game]) -> str:
+    rng = random.Random(0)
+    rows = []
+    for i, game in enumerate(games):
+        score = _score(game, rng) if game.played else "-"
+        report = f'<a href="/ru/match/{i}.html">отчет</a>' if game.played else ""
+        rows.append(
+            f"<tr><td>{game.day.strftime('%d.%m.%Y')} ({WEEKDAYS[game.day.weekday()]})</td>"
+            f"<td>{game.time}</td><td>{game.arena}</td><td> {game.team1} </td>"
+            f"<td>{score}</td><td> {game.team2} </td><td>{report}</td><td></td></tr>"
+        )
+    return (
+        f'<html><body><ul class="menu">{CHROME}</ul><table class="calendar"><thead><tr>'
+        "<th>Дата</th><th>Время</th><th>Арена</th><th>Хозяева</th><th>Счет</th><th>Гости</th>"
+        f"<th></th><th></th></tr></thead><tbody>{''.join(rows)}</tbody></table></body></html>"
+    )
+
+
+def render_alh(games: list[Game]) -> str:
+    rng = random.Random(0)
+    rows = []
+    for i, game in enumerate(games):
+        rows.append(
+            f'<tr class="sectiontableentry{1 + i % 2}"><td>{i + 1}</td><td>{game.arena}</td>'
+            f"<td>{game.day.strftime('%d.%m.%Y')}</td><td>{game.time}</td><td>{game.team1}</td>"
+            f"<td></td><td>{_score(game, rng) if game.played else '-'}</td><td></td><td>{game.team2}</td></tr>"
+        )
+    return (
+        f'<html><body><ul class="menu">{CHROME}</ul>'
+        f'<table class="contentpaneopen">{"".join(rows)}</table></body></html>'
+    )
+
+
+RENDERERS = {"nhl": render_nhl, "lhl": render_lhl, "alh": render_alh}
+
+
+def render(league: str, games: list[Game]) -> str:
+    return RENDERERS[league](games)
+
+
+def recorded_page(league: str) -> str | None:
+    """
+    Returns the page of the league saved by --record, None if there is none.
+    """
+    path = os.path.join(RECORDED_DIR, f"{league}.html")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def record_page(league: str, html: str):
+    os.makedirs(RECORDED_DIR, exist_ok=True)
+    with open(os.path.join(RECORDED_DIR, f"{league}.html"), "w", encoding="utf-8") as f:
+        f.write(html)
+
+
+class LeagueSites:
+    """
+    Local stand-in for the league sites: serves pages by path with ETags and answers
+    conditional requests with 304 like the real sites do.
+    """
+
+    def __init__(self, delay: float = 0.0):
+        self.pages: dict[str, str] = {}
+        self.delay = delay
+        self.requests = Counter()
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.root = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def url(self, league: str) -> str:
+        return f"{self.root}/{league}"
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests.clear()
+            self.bytes = 0
+
+    def _handler(self):
+        sites = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                time.sleep(sites.delay)
+                body = sites.pages.get(self.path.strip("/"))
+                if body is None:
+                    self._reply(404, b"")
+                    return
+                data = body.encode("utf-8")
+                etag = f'"{hashlib.md5(data).hexdigest()}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self._reply(304, b"", etag)
+                    return
+                self._reply(200, data, etag)
+
+            def _reply(self, status: int, data: bytes, etag: str | None = None):
+                with sites._lock:
+                    sites.requests[status] += 1
+                    sites.bytes += len(data)
+                self.send_response(status)
+                if etag:
+                    self.send_header("ETag", etag)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
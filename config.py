@@ -0,0 +1,45 @@
+import configparser
+import threading
+
+CONFIG_FILE = "urls.ini"
+
+_config: configparser.ConfigParser | None = None
+_config_lock = threading.Lock()
+
+
+def load_config(path: str = CONFIG_FILE) -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+
+def get_config() -> configparser.ConfigParser:
+    """
+    Returns urls.ini parsed once for the whole process.
+    """
+    global _config
+    with _config_lock:
+        if _config is None:
+            _config = load_config()
+        return _config
+
+
+def reload_config() -> configparser.ConfigParser:
+    """
+    Parses urls.ini again, modules pick up the new values on their next call to get_config.
+    """
+    global _config
+    with _config_lock:
+        _config = load_config()
+        return _config
+
+
+def config_dict(
+    config: configparser.ConfigParser | None = None,
+) -> dict[str, dict[str, str]]:
+    """
+    Returns the config as plain dicts by section.
+    """
+    if config is None:
+        config = get_config()
+    return {section: dict(config[section]) for section in config.sections()}
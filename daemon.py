@@ -0,0 +1,181 @@
+import random
+import signal
+import threading
+import time
+from datetime import datetime, timedelta
+import google_calendar_client as ggc
+from config import config_dict, reload_config
+from ics_feed import write_feeds
+from logger import Logger
+import metrics
+from parser import Event
+import resilience
+from pipeline import (
+    FetchJob,
+    expire_rejected_events,
+    fetch_league,
+    league_jobs,
+    sync_window,
+    upcoming_events,
+)
+from scheduler import plan_poll
+from storage import get_store
+
+logger = Logger(__name__)
+
+DEFAULT_JITTER = 60  # max seconds added to or taken from every interval
+# calendar is synced at least this often even if no league page changed
+RESYNC_INTERVAL = 60 * 60
+IDLE_WAIT = 60
+
+
+class Daemon:
+    """
+    Keeps the calendar service, HTTP sessions and caches warm in one long-running process
+    and polls every league when the scheduler finds it due.
+
+    SIGTERM and SIGINT stop the daemon after the current sync, SIGHUP reloads urls.ini.
+    Every poll is recorded as a run of its own.
+    """
+
+    def __init__(self, profile: bool = False, trace_memory: bool = False):
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.running = False
+        self.reload_requested = False
+        self.wake = threading.Event()
+        self.config: dict[str, dict[str, str]] = {}
+        self.service = None
+        self.jobs: dict[str, FetchJob] = {}
+        self.events: dict[str, list[Event]] = {}
+        # end of the window every league was last parsed with
+        self.window_ends: dict[str, datetime | None] = {}
+        self.next_run: dict[str, float] = {}
+        self.last_sync = 0.0
+        self.last_cleanup = None
+
+    def _handle_stop(self, signum, frame):
+        logger.info(f"Got signal {signum}, stopping")
+        self.running = False
+        self.wake.set()
+
+    def _handle_reload(self, signum, frame):
+        logger.info("Got SIGHUP, reloading config")
+        self.reload_requested = True
+        self.wake.set()
+
+    def _setting(self, name: str, default: float) -> float:
+        return float(self.config.get("daemon", {}).get(name, default))
+
+    def schedule(self, league: str, now: float):
+        plan = plan_poll(self.config, league, now)
+        jitter = min(self._setting("jitter", DEFAULT_JITTER), plan.interval / 2)
+        self.next_run[league] = plan.next_poll + random.uniform(-jitter, jitter)
+        logger.debug(str(plan))
+
+    def load(self):
+        self.config = config_dict(reload_config())
+        # leagues without a parser or an url are never polled
+        self.jobs = league_jobs(self.config)
+        leagues = list(self.jobs)
+        now = time.time()
+        self.next_run = {league: self.next_run.get(league, now) for league in leagues}
+        self.events = {
+            league: events
+            for league, events in self.events.items()
+            if league in leagues
+        }
+        self.window_ends = {
+            league: end for league, end in self.window_ends.items() if league in leagues
+        }
+
+    def tick(self, league: str):
+        window = sync_window(self.config)
+        result = fetch_league(self.config, league, window)
+        if result is None:
+            return
+        events, changed = result
+        self.events[league] = events
+        self.window_ends[league] = window.end
+        # games of the leagues not fetched yet are unknown, the sync keeps them
+        unfetched = {
+            job.parse.tag for name, job in self.jobs.items() if name not in self.events
+        }
+
+        due = (
+            changed
+            or time.time() - self.last_sync
+            > self._setting("resync_interval", RESYNC_INTERVAL)
+            or get_store().pending_prompts()
+        )
+        if not due:
+            logger.debug(f"{league} unchanged, skipping sync")
+            return
+        expire_rejected_events(self.config)
+        merged = upcoming_events(
+            [event for events in self.events.values() for event in events],
+            window.start,
+        )
+        write_feeds(self.config, merged, unfetched)
+        if self.service is not None:
+            ends = [end for end in self.window_ends.values() if end is not None]
+            ggc.refresh_calendar(
+                self.service,
+                self.config["cals"],
+                merged,
+                # leagues parsed earlier today may stop at an earlier end
+                min(ends) if ends else None,
+                unfetched,
+            )
+        self.last_sync = time.time()
+
+    def cleanup_logs(self):
+        today = datetime.now().date()
+        if self.last_cleanup != today:
+            logger.clean_logs_up_to_date(
+                (datetime.now() - timedelta(days=10)).strftime("%Y%m%d")
+            )
+            self.last_cleanup = today
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+
+        self.load()
+        if self.config.get("cals"):
+            self.service = ggc.get_calendar_service()
+            if self.service is None:
+                logger.error("No calendar service, daemon is not started")
+                return
+        self.running = True
+        logger.info(f"Daemon started for {', '.join(self.next_run) or 'no leagues'}")
+
+        while self.running:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.load()
+            if not self.next_run:
+                self.wake.wait(IDLE_WAIT)
+                self.wake.clear()
+                continue
+
+            league, due = min(self.next_run.items(), key=lambda item: item[1])
+            wait = due - time.time()
+            if wait > 0:
+                self.wake.wait(wait)
+                self.wake.clear()
+                continue
+
+            metrics.start_run(f"daemon {league}", self.profile, self.trace_memory)
+            resilience.start_run_deadline(self.config)
+            try:
+                self.tick(league)
+            except Exception as e:
+                logger.error(f"Couldn't sync {league}: {e}", exc_info=True)
+            finally:
+                resilience.start_deadline(None)
+                metrics.finish_run()
+            self.schedule(league, time.time())
+            self.cleanup_logs()
+        logger.info("Daemon stopped")
@@ -1,87 +1,276 @@
+from __future__ import annotations
+
 import os.path
 from datetime import datetime, timedelta
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build, Resource
-from googleapiclient.errors import HttpError
 from logger import Logger
-from collections import defaultdict
-from parser import Event
-from telegram_notifications import ask_confirmation, send_notification
+import metrics
+import resilience
+from storage import get_store
+from parser import Event, MINSK_TZ, parse_datetime
+from sync_plan import SyncPlan, build_plan, load_rejected_events, save_rejected_events
+from telegram_notifications import (
+    Notifier,
+    collect_confirmations,
+    request_confirmations,
+)
+from config import config_dict, get_config
+from leagues import get_registry
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import json
-import configparser
-
-
-config = configparser.ConfigParser()
-config.read("urls.ini")
+import threading
+import time
+from typing import TYPE_CHECKING, Callable
 
+# google client libraries take longer to import than the rest of a run that finds no changes,
+# so they are imported by the functions that talk to the API
+if TYPE_CHECKING:
+    from google.oauth2.credentials import Credentials
+    from googleapiclient.discovery import Resource
+    from googleapiclient.http import HttpRequest
 
 logger = Logger(__name__)
 SCOPES = ["https://www.googleapis.com/auth/calendar"]
 
 dt_format = "%Y-%m-%dT%H:%M:%S+03:00"  # datetime format for google calendar
 
+CALENDAR_IDS_TTL = 7 * 24 * 60 * 60  # seconds
+
+# fields of the events kept in the local copy of the calendars
+MIRROR_FIELDS = ("id", "summary", "description", "start", "end")
+
+BATCH_SIZE = 50  # max number of calls in one batch request
+BATCH_RETRIES = 3
+# calendar API requests in flight at once across all calendars synced concurrently
+MAX_CONCURRENT_REQUESTS = 4
+MAX_CALENDAR_WORKERS = 8
+CALENDAR_HOST = "www.googleapis.com"
+
+_calendar_ids: dict[str, dict[str, str | float]] | None = None
+_calendar_ids_lock = threading.Lock()
+
+_credentials: Credentials | None = None
+_discovery_document: dict | None = None
+_credentials_lock = threading.Lock()
+_local = threading.local()
+_request_budget: threading.BoundedSemaphore | None = None
+_sync_pool: ThreadPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+
+class CountingHttp:
+    """
+    Wraps the authorized HTTP of the calendar service to count every request, batches included,
+    in the run metrics.
+    """
+
+    def __init__(self, http):
+        self.http = http
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        started = time.perf_counter()
+        response, content = self.http.request(
+            uri, method, body=body, headers=headers, **kwargs
+        )
+        metrics.count_request(
+            "calendar",
+            len(body) if body else 0,
+            len(content or b""),
+            time.perf_counter() - started,
+        )
+        return response, content
+
+    def __getattr__(self, name):
+        # credentials, timeout and the rest are read by googleapiclient from the wrapped HTTP
+        return getattr(self.http, name)
+
+
+def discovery_document() -> dict:
+    """
+    Returns the Calendar API discovery document bundled with googleapiclient, parsed once per process.
+    """
+    global _discovery_document
+    with _credentials_lock:
+        if _discovery_document is None:
+            from googleapiclient.discovery_cache import get_static_doc
+
+            _discovery_document = json.loads(get_static_doc("calendar", "v3"))
+        return _discovery_document
+
 
 def get_calendar_service() -> Resource:
     """
     Returns a service object for the Google Calendar API.
+    Credentials are read once per process and shared by the services of all threads,
+    the service is built from the bundled discovery document without fetching it.
     """
-    creds = None
-    if os.path.exists("token.json"):
-        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.discovery import build_from_document
+    from googleapiclient.errors import HttpError
+    from googleapiclient.http import build_http
 
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            if not os.path.exists("credentials.json"):
-                logger.error(
-                    "credentials.json not found. Please download it from Google Cloud Console."
+    global _credentials
+    with _credentials_lock:
+        creds = _credentials
+        if creds is None and os.path.exists("token.json"):
+            from google.oauth2.credentials import Credentials
+
+            creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                from google.auth.transport.requests import Request
+
+                creds.refresh(Request())
+            else:
+                if not os.path.exists("credentials.json"):
+                    logger.error(
+                        "credentials.json not found. Please download it from Google Cloud Console."
+                    )
+                    return None
+                from google_auth_oauthlib.flow import InstalledAppFlow
+
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    "credentials.json", SCOPES
                 )
-                return None
-            flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
-            creds = flow.run_local_server(port=0)
+                creds = flow.run_local_server(port=0)
 
-        with open("token.json", "w") as token:
-            token.write(creds.to_json())
+            with open("token.json", "w") as token:
+                token.write(creds.to_json())
+        _credentials = creds
 
     try:
-        service = build("calendar", "v3", credentials=creds)
+        service = build_from_document(
+            discovery_document(),
+            http=CountingHttp(AuthorizedHttp(creds, http=build_http())),
+        )
         return service
     except HttpError as e:
         logger.error(f"An error occurred: {e}")
         return None
 
 
+def thread_service() -> Resource:
+    """
+    Returns the calendar service of the current thread, services can't be shared between threads
+    as their HTTP connections are not thread safe.
+    """
+    service = getattr(_local, "service", None)
+    if service is None:
+        service = get_calendar_service()
+        _local.service = service
+    return service
+
+
+def request_budget() -> threading.BoundedSemaphore:
+    """
+    Returns the semaphore limiting calendar requests in flight, [sync] calendar_requests at a time.
+    """
+    global _request_budget
+    with _pool_lock:
+        if _request_budget is None:
+            _request_budget = threading.BoundedSemaphore(
+                get_config().getint(
+                    "sync", "calendar_requests", fallback=MAX_CONCURRENT_REQUESTS
+                )
+            )
+        return _request_budget
+
+
+def execute(request, retries: int = resilience.RETRIES):
+    """
+    Executes a calendar request or a batch of them within the shared request budget.
+    Rate limits, server errors and network failures are retried up to retries times with backoff,
+    waiting as long as the server asks in Retry-After. Fails fast with DeadlineExceeded after
+    the run deadline and with resilience.Unavailable while the circuit breaker skips the calendar API.
+    """
+    from googleapiclient.errors import HttpError
+
+    retry = resilience.Retry(retries)
+    while True:
+        resilience.check_deadline("a calendar request")
+        if not resilience.breaker.allow(CALENDAR_HOST):
+            raise resilience.Unavailable(f"{CALENDAR_HOST} keeps failing")
+        try:
+            with request_budget(), metrics.span("calendar"):
+                response = request.execute()
+        except Exception as e:
+            if not is_retriable(e):
+                raise
+            delay = None
+            if isinstance(e, HttpError):
+                delay = resilience.retry_after(e.resp.get("retry-after"))
+            if retry.wait(delay):
+                logger.warning(f"Calendar request failed: {e}, retrying")
+                continue
+            resilience.breaker.failure(CALENDAR_HOST)
+            raise
+        resilience.breaker.success(CALENDAR_HOST)
+        return response
+
+
 def get_calendar_id_by_name(service: Resource, calendar_name: str) -> str:
     """
     Returns the ID of the calendar with the given name.
+    IDs are resolved once per process and kept in the state store for CALENDAR_IDS_TTL.
     """
-    try:
-        page_token = None
-        while True:
-            calendar_list = service.calendarList().list(pageToken=page_token).execute()
-            for calendar_list_entry in calendar_list["items"]:
-                if calendar_list_entry["summary"] == calendar_name:
-                    return calendar_list_entry["id"]
-            page_token = calendar_list.get("nextPageToken")
-            if not page_token:
-                break
-    except HttpError as e:
-        logger.error(f"An error occurred while listing calendars: {e}")
-    return None
+    from googleapiclient.errors import HttpError
 
+    with _calendar_ids_lock:
+        global _calendar_ids
+        if _calendar_ids is None:
+            _calendar_ids = get_store().get_value("calendar_ids", {})
+        entry = _calendar_ids.get(calendar_name)
+        if entry and time.time() - entry["resolved_at"] < CALENDAR_IDS_TTL:
+            return entry["id"]
 
-def insert_into_calendar(service: Resource, event_data: Event, calendar_name: str):
-    try:
-        service.events().insert(
-            calendarId=get_calendar_id_by_name(service, calendar_name),
-            body=to_calendar_format(event_data),
-        ).execute()
-        logger.info(f"Event created: {event_data}")
-    except Exception as e:
-        logger.error(f"Couldn't insert an event: {e}")
+        resolved = {}
+        try:
+            page_token = None
+            while True:
+                calendar_list = execute(
+                    service.calendarList().list(pageToken=page_token)
+                )
+                for calendar_list_entry in calendar_list["items"]:
+                    resolved.setdefault(
+                        calendar_list_entry["summary"], calendar_list_entry["id"]
+                    )
+                page_token = calendar_list.get("nextPageToken")
+                if not page_token:
+                    break
+        except HttpError as e:
+            logger.error(f"An error occurred while listing calendars: {e}")
+            return None
+
+        # one listing resolves every calendar of the account
+        now = time.time()
+        for name, calendar_id in resolved.items():
+            _calendar_ids[name] = {"id": calendar_id, "resolved_at": now}
+        get_store().set_value("calendar_ids", _calendar_ids)
+        return resolved.get(calendar_name)
+
+
+def invalidate_calendar_id(calendar_name: str):
+    """
+    Forgets the cached ID of the calendar, so it is resolved again on the next call.
+    """
+    with _calendar_ids_lock:
+        global _calendar_ids
+        if _calendar_ids is None:
+            _calendar_ids = get_store().get_value("calendar_ids", {})
+        if _calendar_ids.pop(calendar_name, None) is not None:
+            logger.info(f"Calendar id of {calendar_name} is no longer valid")
+            get_store().set_value("calendar_ids", _calendar_ids)
+
+
+def handle_not_found(e: Exception, calendar_name: str):
+    """
+    Invalidates the calendar id if the API answered 404 for it.
+    """
+    from googleapiclient.errors import HttpError
+
+    if isinstance(e, HttpError) and e.resp.status == 404:
+        invalidate_calendar_id(calendar_name)
 
 
 def to_calendar_format(event: Event) -> dict[str, str | dict[str]]:
@@ -94,7 +283,7 @@ def to_calendar_format(event: Event) -> dict[str, str | dict[str]]:
             "description": f"{event.teams}",
             "start": {"dateTime": f"{event.dateTime}", "timeZone": "Europe/Minsk"},
             "end": {
-                "dateTime": f"{(datetime.strptime(event.dateTime, dt_format) + timedelta(minutes=75)).strftime(dt_format)}",
+                "dateTime": f"{(event.start + timedelta(minutes=75)).strftime(dt_format)}",
                 "timeZone": "Europe/Minsk",
             },
         }
@@ -103,14 +292,22 @@ def to_calendar_format(event: Event) -> dict[str, str | dict[str]]:
     return event_data
 
 
-def from_calendar_format(event: dict[str, str | dict[str]]) -> Event:
+def from_calendar_format(event: dict[str, str | dict[str]]) -> Event | None:
     """
     Converts event from the format required by the google calendar to Event object.
+    None for events that don't follow the format of the sync, like ones added by hand.
     """
+    summary = event.get("summary", "").strip()
+    if " " not in summary:
+        logger.debug(f"Skipping calendar event {summary!r} not written by the sync")
+        return None
     try:
+        # arenas kept under their own names may have spaces, league tags don't
+        arena, league = summary.rsplit(" ", 1)
         return Event(
             event.get("start", {}).get("dateTime", ""),
-            *event.get("summary", "").split(),
+            arena,
+            league,
             event.get("description", ""),
         )
     except Exception as e:
@@ -127,66 +324,473 @@ def add_to_table(table: Resource, event: Event):
         logger.error(f"Error adding event to table: {e}")
 
 
+def _mirror_item(event: dict) -> dict:
+    # only the fields needed to rebuild an Event are kept in the mirror
+    return {key: event[key] for key in MIRROR_FIELDS if key in event}
+
+
+def list_calendar_events(service: Resource, calendar_id: str) -> dict[str, dict]:
+    """
+    Returns all events of the calendar by their ids.
+
+    The first call pages through the whole calendar and stores it with the sync token in the mirror,
+    later calls fetch only the events changed since then. Falls back to the full sync if the token expired.
+    """
+    from googleapiclient.errors import HttpError
+
+    store = get_store()
+    sync_token = store.get_value(f"sync_token:{calendar_id}")
+    changes = {}
+
+    page_token = None
+    while True:
+        params = {"calendarId": calendar_id, "pageToken": page_token}
+        if sync_token:
+            params["syncToken"] = sync_token
+        else:
+            params["maxResults"] = 2500
+        try:
+            response = execute(service.events().list(**params))
+        except HttpError as e:
+            if e.resp.status == 410 and sync_token:
+                logger.info("Sync token expired, doing a full sync")
+                sync_token = None
+                changes = {}
+                page_token = None
+                continue
+            raise
+        for item in response.get("items", []):
+            if item.get("status") == "cancelled":
+                changes[item["id"]] = None
+            else:
+                changes[item["id"]] = _mirror_item(item)
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            break
+
+    store.update_calendar_events(
+        calendar_id, changes, response.get("nextSyncToken"), full=sync_token is None
+    )
+    return store.get_calendar_events(calendar_id)
+
+
+def is_retriable(e: Exception) -> bool:
+    """
+    Returns True for errors worth retrying: rate limits, server errors and network failures.
+    """
+    from googleapiclient.errors import HttpError
+    from httplib2 import ServerNotFoundError
+
+    if isinstance(e, HttpError):
+        if e.resp.status in resilience.RETRY_STATUSES:
+            return True
+        return e.resp.status == 403 and "ratelimitexceeded" in str(e).lower()
+    # socket timeouts, resets and refused connections, DNS failures
+    return isinstance(e, (TimeoutError, ConnectionError, ServerNotFoundError))
+
+
+def execute_batch(
+    service: Resource, calls: list[tuple[Event, Callable[[], HttpRequest]]]
+) -> list[tuple[Event, dict | None, Exception | None]]:
+    """
+    Executes calendar requests through the batch endpoint, BATCH_SIZE requests per HTTP request.
+    Only the failed requests are retried, with exponential backoff within the run deadline.
+    The batch itself is not retried by execute, so a call is sent at most BATCH_RETRIES + 1 times.
+
+    Args:
+        calls (list): pairs of the event and a function building the request for it
+
+    Returns:
+        list: (event, response, exception) for every call in the original order
+    """
+    results = [(event, None, None) for event, _ in calls]
+    pending = list(range(len(calls)))
+    retry = resilience.Retry(BATCH_RETRIES)
+    while True:
+        failed = []
+        for i in range(0, len(pending), BATCH_SIZE):
+            chunk = pending[i : i + BATCH_SIZE]
+
+            def callback(request_id, response, exception):
+                index = int(request_id)
+                results[index] = (calls[index][0], response, exception)
+                if exception is not None:
+                    failed.append(index)
+
+            batch = service.new_batch_http_request(callback=callback)
+            for index in chunk:
+                batch.add(calls[index][1](), request_id=str(index))
+            try:
+                execute(batch, retries=0)
+            except Exception as e:
+                logger.error(f"Batch request failed: {e}")
+                for index in chunk:
+                    results[index] = (calls[index][0], None, e)
+                failed.extend(chunk)
+        pending = [index for index in failed if is_retriable(results[index][2])]
+        if not pending:
+            break
+        logger.info(f"Retrying {len(pending)} calendar requests")
+        if not retry.wait():
+            break
+    return results
+
+
+def event_key(event: Event) -> str:
+    """
+    Returns a string identifying the event across runs.
+    """
+    return f"{event.dateTime}|{event.teams}"
+
+
+def calendar_event_id(event: Event) -> str:
+    """
+    Returns the id the event is inserted with. Ids follow from the event, so an insert sent again
+    after a lost response is rejected as a duplicate instead of adding the game twice.
+    """
+    # hex digits are valid base32hex, the alphabet of calendar event ids
+    return hashlib.sha1(event_key(event).encode("utf-8")).hexdigest()
+
+
+def is_duplicate(e: Exception | None) -> bool:
+    from googleapiclient.errors import HttpError
+
+    return isinstance(e, HttpError) and e.resp.status == 409
+
+
+def content_hash(event: Event) -> str:
+    """
+    Returns the hash of the event as it is written to the calendar.
+    """
+    body = json.dumps(to_calendar_format(event), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+def restore_duplicates(
+    service: Resource,
+    calendar_id: str,
+    results: list[tuple[Event, dict | None, Exception | None]],
+) -> list[tuple[Event, dict | None, Exception | None]]:
+    """
+    Settles inserts rejected because an event with their id already exists.
+
+    The id is either taken by the insert itself, sent again after its response was lost, or by the event
+    of a game deleted earlier, which the calendar keeps as cancelled. Both are patched back to the game.
+    An id held by another live event, a game moved away from this time, is left to it and the game
+    is inserted under an id of the calendar's choice.
+    """
+    duplicates = [
+        i for i, (_, _, exception) in enumerate(results) if is_duplicate(exception)
+    ]
+    if not duplicates:
+        return results
+    results = list(results)
+    live = get_store().get_calendar_events(calendar_id)
+    calls = []
+    for i in duplicates:
+        event = results[i][0]
+        event_id = calendar_event_id(event)
+        if event_id in live:
+            calls.append(
+                (
+                    event,
+                    lambda event=event: service.events().insert(
+                        calendarId=calendar_id, body=to_calendar_format(event)
+                    ),
+                )
+            )
+        else:
+            calls.append(
+                (
+                    event,
+                    lambda event=event, event_id=event_id: service.events().patch(
+                        calendarId=calendar_id,
+                        eventId=event_id,
+                        body={**to_calendar_format(event), "status": "confirmed"},
+                    ),
+                )
+            )
+    for i, result in zip(duplicates, execute_batch(service, calls)):
+        results[i] = result
+    return results
+
+
+def apply_plan(
+    service: Resource,
+    calendar_id: str,
+    calendar_name: str,
+    plan: SyncPlan,
+    notifier: Notifier,
+    answers: dict[str, bool],
+) -> tuple[int, int, int, dict[str, Event]]:
+    """
+    Applies the plan to the calendar in batch requests.
+
+    New events are inserted once they are confirmed in Telegram. Answers given since the previous run
+    are applied now, events without an answer are returned to be prompted for.
+
+    Returns:
+        tuple[int, int, int, dict[str, Event]]: number of inserted, deleted and moved events
+            and events waiting for a confirmation by their keys
+    """
+    notify_list = get_config()["telegram"]["notify_list"].split(",")
+    calls = []
+    rejected = []
+    prompts = {}
+    for event in plan.to_insert:
+        answer = answers.get(event_key(event))
+        if answer is None:
+            prompts[event_key(event)] = event
+        elif answer:
+            calls.append(
+                (
+                    event,
+                    lambda event=event: service.events().insert(
+                        calendarId=calendar_id,
+                        body={
+                            **to_calendar_format(event),
+                            "id": calendar_event_id(event),
+                        },
+                    ),
+                )
+            )
+        else:
+            rejected.append(event)
+    save_rejected_events(rejected)
+    inserts = len(calls)
+
+    for event, event_id in plan.to_delete:
+        calls.append(
+            (
+                event,
+                lambda event_id=event_id: service.events().delete(
+                    calendarId=calendar_id, eventId=event_id
+                ),
+            )
+        )
+
+    deletes = len(calls)
+
+    # rescheduled games are patched in place, no confirmation needed
+    moves = {}
+    for old_event, event_id, event in plan.to_move:
+        moves[len(calls)] = old_event
+        calls.append(
+            (
+                event,
+                lambda event_id=event_id, event=event: service.events().patch(
+                    calendarId=calendar_id,
+                    eventId=event_id,
+                    body=to_calendar_format(event),
+                ),
+            )
+        )
+
+    results = execute_batch(service, calls)
+    results[:inserts] = restore_duplicates(service, calendar_id, results[:inserts])
+
+    new_count = 0
+    del_count = 0
+    move_count = 0
+    for i, (event, _, exception) in enumerate(results):
+        action = "insert" if i < inserts else "delete" if i < deletes else "move"
+        if exception is not None:
+            handle_not_found(exception, calendar_name)
+            logger.error(f"Couldn't {action} an event {event}: {exception}")
+        elif action == "insert":
+            logger.info(f"Event created: {event}")
+            new_count += 1
+        elif action == "delete":
+            logger.info(f"Deleted event: {event}")
+            del_count += 1
+            notifier.add(f"Отменена игра: {event}")
+            for chat_id in notify_list:
+                notifier.add(f"Отменена игра: {event}", chat_id)
+        else:
+            old_event = moves[i]
+            logger.info(f"Moved event: {old_event} -> {event}")
+            move_count += 1
+            text = f"Перенос игры: {event}\nБыло: {old_event}"
+            notifier.add(text)
+            for chat_id in notify_list:
+                notifier.add(text, chat_id)
+    return new_count, del_count, move_count, prompts
+
+
+def calendar_targets(calendars: dict[str, str]) -> dict[str, set[str]]:
+    """
+    Returns league tags synced to every calendar by the calendar name.
+    Leagues of a calendar are listed in [calendar_leagues] by its key in [cals],
+    only nhl games go to the personal calendar if the section is missing.
+    """
+    config = config_dict()
+    registry = get_registry(config)
+    mapping = config.get("calendar_leagues") or {"personal": "nhl"}
+    targets = {}
+    for key, leagues in mapping.items():
+        if key not in calendars:
+            logger.warning(f"Calendar {key} is not listed in [cals], skipping")
+            continue
+        targets[calendars[key]] = {
+            registry[league.strip()].tag
+            for league in leagues.split(",")
+            if league.strip() in registry
+        }
+    return targets
+
+
+def sync_pool() -> ThreadPoolExecutor:
+    """
+    Returns the pool calendars are synced on. Its threads live as long as the process,
+    so every one of them keeps its calendar service between runs of the daemon.
+    """
+    global _sync_pool
+    with _pool_lock:
+        if _sync_pool is None:
+            _sync_pool = ThreadPoolExecutor(
+                max_workers=MAX_CALENDAR_WORKERS, thread_name_prefix="calendar"
+            )
+        return _sync_pool
+
+
+def sync_calendar(
+    service: Resource,
+    calendar_name: str,
+    leagues: set[str],
+    parsed_events: list[Event],
+    rejected_events: set[Event],
+    answers: dict[str, bool],
+    notifier: Notifier,
+    time_max: datetime | None = None,
+    unfetched: set[str] | None = None,
+) -> tuple[int, int, int, dict[str, Event]]:
+    """
+    Brings events of the leagues in one calendar in line with the parsed events.
+    Events starting after time_max are left alone, the list was parsed only up to it,
+    and so are events of the unfetched leagues.
+
+    Returns:
+        tuple[int, int, int, dict[str, Event]]: number of inserted, deleted and moved events
+            and events waiting for a confirmation by their keys
+    """
+    calendar_id = get_calendar_id_by_name(service, calendar_name)
+    raw_cal_events = list_calendar_events(service, calendar_id)
+    # same filter as timeMin of events.list: events ending after now + 75 minutes
+    time_min = datetime.now(MINSK_TZ) + timedelta(minutes=75)
+    calendar_event_objs = {}
+    # reformat events from calendar to Event objects with their ids
+    for event_id, event in raw_cal_events.items():
+        end = parse_datetime(event.get("end", {}).get("dateTime"))
+        start = parse_datetime(event.get("start", {}).get("dateTime"))
+        if time_max is not None and start is not None and start > time_max:
+            continue
+        if end is not None and end > time_min:
+            calendar_event = from_calendar_format(event)
+            if calendar_event is not None:
+                calendar_event_objs[calendar_event] = event_id
+
+    with metrics.span("diff"):
+        plan = build_plan(
+            parsed_events, calendar_event_objs, rejected_events, leagues, unfetched
+        )
+    return apply_plan(service, calendar_id, calendar_name, plan, notifier, answers)
+
+
 def refresh_calendar(
-    service: Resource, calendars: dict[str, str], parsed_events: list[Event]
+    service: Resource,
+    calendars: dict[str, str],
+    parsed_events: list[Event],
+    time_max: datetime | None = None,
+    unfetched: set[str] | None = None,
 ):
     """
-    Compares events in the calendar with events in the list to keep only their intersection.
+    Compares events in every target calendar with events in the list to keep only their intersection.
+
+    All calendars are planned from the same parsed events and synced concurrently, every thread
+    with its own service, within a shared budget of requests in flight. Telegram answers are read
+    once for all calendars and a game waiting for a confirmation in several calendars is prompted once.
+    Events starting after time_max are left alone, the list was parsed only up to it, and so are
+    events of the unfetched leagues, which couldn't be fetched and were never parsed.
     """
+    notifier = Notifier()
     try:
-        raw_cal_events = (
-            service.events()
-            .list(
-                calendarId=get_calendar_id_by_name(service, calendars["personal"]),
-                timeMin=(datetime.now() + timedelta(minutes=75)).strftime(dt_format),
+        targets = calendar_targets(calendars)
+        answers = collect_confirmations(notifier=notifier)
+        rejected_events = load_rejected_events()
+
+        def sync(calendar_name: str, leagues: set[str], calendar_service: Resource):
+            return sync_calendar(
+                calendar_service or thread_service(),
+                calendar_name,
+                leagues,
+                parsed_events,
+                rejected_events,
+                answers,
+                notifier,
+                time_max,
+                unfetched,
             )
-            .execute()
-        )
-        calendar_event_objs = defaultdict(str)
-        new_count = 0
-        del_count = 0
-        notify_list = config["telegram"]["notify_list"].split(",")
-        # reformat events from calendar to Event objects with their ids
-        for event in raw_cal_events["items"]:
-            calendar_event_objs.update({from_calendar_format(event): event["id"]})
-
-        # Add events that are in the parsed list but not in the calendar (new events)
-        for event in [x for x in parsed_events if x.league == "сер"]:
-            if event not in calendar_event_objs.keys():
-                with open("rejected_events.json", "r") as f:
-                    rejected_events = [Event(**json.loads(line)) for line in f]
-                if event in rejected_events:
-                    continue
-                if ask_confirmation(f"Новая игра: {event}"):
-                    insert_into_calendar(service, event, calendars["personal"])
-                    new_count += 1
-                else:
-                    with open("rejected_events.json", "a") as f:
-                        f.write(json.dumps(event.to_json()) + "\n")
-                for chat_id in notify_list:
-                    send_notification(f"Новая игра: {event}", chat_id)
-
-        # Delete events that are in the calendar but not in the parsed list (cancellations)
-        for event, event_id in calendar_event_objs.items():
-            if event not in parsed_events:
-                if event.league == "сер":
-                    service.events().delete(
-                        calendarId=get_calendar_id_by_name(
-                            service, calendars["personal"]
-                        ),
-                        eventId=event_id,
-                    ).execute()
-                    logger.info(f"Deleted event: {event}")
-                    del_count += 1
-                    send_notification(f"Отменена игра: {event}")
-                    for chat_id in notify_list:
-                        send_notification(f"Отменена игра: {event}", chat_id)
-
-        if new_count > 0 or del_count > 0:
-            logger.info(f"Added {new_count} events and deleted {del_count} events.")
-            send_notification(f"""{f"Добавлено {new_count} игр" if new_count > 0 else ""}
-                                {f"\nУдалено {del_count} игр" if del_count > 0 else ""}""")
+
+        results = {}
+        if len(targets) == 1:
+            # a single calendar is synced right here with the service of the caller
+            ((calendar_name, leagues),) = targets.items()
+            try:
+                results[calendar_name] = sync(calendar_name, leagues, service)
+            except Exception as e:
+                handle_not_found(e, calendar_name)
+                logger.error(
+                    f"Couldn't refresh calendar {calendar_name}: {e}", exc_info=True
+                )
         else:
-            logger.info("No changes detected.")
+            futures = {
+                calendar_name: sync_pool().submit(sync, calendar_name, leagues, None)
+                for calendar_name, leagues in targets.items()
+            }
+            for calendar_name, future in futures.items():
+                try:
+                    results[calendar_name] = future.result()
+                except Exception as e:
+                    handle_not_found(e, calendar_name)
+                    logger.error(
+                        f"Couldn't refresh calendar {calendar_name}: {e}", exc_info=True
+                    )
+
+        prompts = {}
+        for calendar_name, (
+            new_count,
+            del_count,
+            move_count,
+            waiting,
+        ) in results.items():
+            prompts.update(waiting)
+            metrics.count("inserted", new_count)
+            metrics.count("deleted", del_count)
+            metrics.count("moved", move_count)
+            if new_count > 0 or del_count > 0 or move_count > 0:
+                logger.info(
+                    f"{calendar_name}: added {new_count} events, deleted {del_count} events and moved {move_count} events."
+                )
+                summary = [f"{calendar_name}:"] if len(targets) > 1 else []
+                if new_count > 0:
+                    summary.append(f"Добавлено {new_count} игр")
+                if del_count > 0:
+                    summary.append(f"Удалено {del_count} игр")
+                if move_count > 0:
+                    summary.append(f"Перенесено {move_count} игр")
+                notifier.add("\n".join(summary))
+            else:
+                logger.info(f"{calendar_name}: no changes detected.")
+
+        sent = request_confirmations(
+            {key: f"Новая игра: {event}" for key, event in prompts.items()}
+        )
+        metrics.count("prompted", len(sent))
+        notify_list = get_config()["telegram"]["notify_list"].split(",")
+        for key in sent:
+            for chat_id in notify_list:
+                notifier.add(f"Новая игра: {prompts[key]}", chat_id)
     except Exception as e:
-        logger.error(f"Couldn't refresh calendar: {e}", exc_info=True)
+        logger.error(f"Couldn't refresh calendars: {e}", exc_info=True)
+    finally:
+        notifier.flush()
@@ -0,0 +1,119 @@
+import hashlib
+import json
+from logger import Logger
+from storage import get_store
+
+logger = Logger(__name__)
+
+
+def body_hash(body: str) -> str:
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+class BlockCache:
+    """
+    Events extracted from every block of a page (a day or a table row) by the fingerprint of the block.
+
+    A parse takes blocks it has seen before from the previous parse and extracts only the new ones.
+    Blocks that are not on the page anymore are dropped when the cache is saved.
+    """
+
+    def __init__(self, url: str, previous: dict[str, dict] | None = None):
+        self.url = url
+        self.previous = previous or {}
+        self.current: dict[str, dict] = {}
+        self.added: list = []
+        self.removed: list = []
+
+    def get(self, fingerprint: str) -> dict | None:
+        data = self.previous.get(fingerprint)
+        if data is not None:
+            self.current[fingerprint] = data
+        return data
+
+    def put(self, fingerprint: str, data: dict):
+        self.current[fingerprint] = data
+
+    @property
+    def reused(self) -> int:
+        return sum(fingerprint in self.previous for fingerprint in self.current)
+
+
+class HttpCache:
+    """
+    Cache of fetched pages keyed by URL, kept in the state store.
+
+    Every entry keeps the body, the validators sent back by the server (ETag and Last-Modified),
+    the hash of the body and, once a parser has run over it, the events parsed from that body.
+    """
+
+    def get(self, url: str) -> dict | None:
+        return get_store().get_page(url)
+
+    def put(self, url: str, entry: dict):
+        get_store().put_page(url, entry)
+
+    def record_fetch(self, url: str, changed: bool):
+        get_store().record_fetch(url, changed)
+
+    def fetch_history(self, url: str) -> list[tuple[float, bool]]:
+        return get_store().fetch_history(url)
+
+    def events_changed(self, url: str, events: list[dict]) -> bool:
+        """
+        Returns whether the events differ from the ones of the previous call for the url and remembers them.
+        """
+        digest = hashlib.sha256(
+            json.dumps(events, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        ).hexdigest()
+        key = f"events_digest:{url}"
+        if get_store().get_value(key) == digest:
+            return False
+        get_store().set_value(key, digest)
+        return True
+
+    def load_blocks(self, url: str) -> BlockCache:
+        return BlockCache(url, get_store().get_page_blocks(url))
+
+    def store_blocks(self, blocks: BlockCache):
+        get_store().put_page_blocks(blocks.url, blocks.current)
+
+    def conditional_headers(
+        self, url: str, entry: dict | None = None
+    ) -> dict[str, str]:
+        """
+        Returns If-None-Match/If-Modified-Since headers for the cached copy of the url.
+        """
+        if entry is None:
+            entry = self.get(url)
+        headers = {}
+        if not entry or entry.get("body") is None:
+            return headers
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def store_events(self, url: str, events: list[dict], tag: str = ""):
+        """
+        Stores events parsed from the cached body, tag tells apart parses limited to different windows.
+        """
+        entry = self.get(url)
+        if entry is None:
+            return
+        get_store().put_page_events(url, events, f"{entry.get('body_hash')}{tag}")
+
+    def load_events(self, url: str, tag: str | None = "") -> list[dict] | None:
+        """
+        Returns events parsed from the cached body with the same tag, from any parse of it if tag is None.
+        None if the body was not parsed yet.
+        """
+        entry = self.get(url)
+        if not entry or not entry.get("events_hash") or not entry.get("body_hash"):
+            return None
+        if tag is None:
+            parsed = entry["events_hash"].startswith(entry["body_hash"])
+        else:
+            parsed = entry["events_hash"] == f"{entry['body_hash']}{tag}"
+        return entry.get("events") if parsed else None
@@ -0,0 +1,216 @@
+import hashlib
+import os
+import tempfile
+import time
+from datetime import datetime, timezone
+from google_calendar_client import (
+    calendar_event_id,
+    content_hash,
+    event_key,
+    to_calendar_format,
+)
+from leagues import get_registry
+from logger import Logger
+import metrics
+from parser import Event
+from storage import get_store
+
+logger = Logger(__name__)
+
+DEFAULT_FEEDS_DIR = "feeds"
+PRODID = "-//Hockey calendar parser//RU"
+UID_DOMAIN = "hockey-calendar-parser"
+LINE_LIMIT = 75  # octets per line of an iCalendar file, longer lines are folded
+
+
+def feed_targets(config: dict[str, dict[str, str]]) -> dict[str, set[str]]:
+    """
+    Returns league tags of every feed from [ics_feeds], feed name = comma separated leagues.
+    """
+    registry = get_registry(config)
+    return {
+        name: {
+            registry[league.strip()].tag
+            for league in leagues.split(",")
+            if league.strip() in registry
+        }
+        for name, leagues in config.get("ics_feeds", {}).items()
+    }
+
+
+def escape(text: str) -> str:
+    return (
+        text.replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\n", "\\n")
+    )
+
+
+def fold(line: str) -> str:
+    """
+    Folds the content line into lines of at most LINE_LIMIT octets without splitting a character.
+    """
+    data = line.encode("utf-8")
+    if len(data) <= LINE_LIMIT:
+        return line
+    parts = []
+    limit = LINE_LIMIT
+    while data:
+        cut = min(limit, len(data))
+        # continuation bytes of UTF-8 start with 10
+        while cut < len(data) and data[cut] & 0xC0 == 0x80:
+            cut -= 1
+        parts.append(data[:cut].decode("utf-8"))
+        data = data[cut:]
+        # continuation lines start with a space
+        limit = LINE_LIMIT - 1
+    return "\r\n ".join(parts)
+
+
+def utc_stamp(date_str: str) -> str:
+    return (
+        datetime.fromisoformat(date_str)
+        .astimezone(timezone.utc)
+        .strftime("%Y%m%dT%H%M%SZ")
+    )
+
+
+def revisions(
+    events: list[Event], previous: dict[str, list], now: float
+) -> dict[str, list]:
+    """
+    Returns [content hash, changed at, sequence] of every event by its key. An event keeps its revision
+    while its content stays the same, a changed one gets the current time and the next sequence.
+    """
+    result = {}
+    for event in events:
+        digest = content_hash(event)
+        revision = previous.get(event_key(event))
+        if revision is None:
+            revision = [digest, now, 0]
+        elif revision[0] != digest:
+            revision = [digest, now, revision[2] + 1]
+        result[event_key(event)] = revision
+    return result
+
+
+def render_event(event: Event, changed_at: float, sequence: int = 0) -> list[str]:
+    """
+    Returns content lines of the event, with the same summary, description and duration
+    as the event gets in Google Calendar. DTSTAMP, LAST-MODIFIED and SEQUENCE follow the last
+    change of the event, so clients pick up a game moved to another rink under the same UID.
+    """
+    data = to_calendar_format(event)
+    start = utc_stamp(data["start"]["dateTime"])
+    modified = datetime.fromtimestamp(changed_at, timezone.utc).strftime(
+        "%Y%m%dT%H%M%SZ"
+    )
+    return [
+        "BEGIN:VEVENT",
+        f"UID:{calendar_event_id(event)}@{UID_DOMAIN}",
+        f"DTSTAMP:{modified}",
+        f"LAST-MODIFIED:{modified}",
+        f"SEQUENCE:{sequence}",
+        f"DTSTART:{start}",
+        f"DTEND:{utc_stamp(data['end']['dateTime'])}",
+        f"SUMMARY:{escape(data['summary'])}",
+        f"DESCRIPTION:{escape(data['description'])}",
+        "END:VEVENT",
+    ]
+
+
+def render_feed(
+    name: str, events: list[Event], event_revisions: dict[str, list] | None = None
+) -> str:
+    """
+    Renders the events sorted by start and teams into an iCalendar file.
+    Events without a revision are stamped with the current time.
+    """
+    if event_revisions is None:
+        event_revisions = revisions(events, {}, time.time())
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        f"PRODID:{PRODID}",
+        "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH",
+        f"X-WR-CALNAME:{escape(name)}",
+        "X-WR-TIMEZONE:Europe/Minsk",
+    ]
+    for event in sorted(events, key=lambda event: (event.start, event.teams or "")):
+        _, changed_at, sequence = event_revisions[event_key(event)]
+        lines.extend(render_event(event, changed_at, sequence))
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(fold(line) for line in lines) + "\r\n"
+
+
+def events_hash(events: list[Event]) -> str:
+    return hashlib.sha256(
+        "\n".join(sorted(content_hash(event) for event in events)).encode("utf-8")
+    ).hexdigest()
+
+
+def write_atomic(path: str, content: str):
+    """
+    Writes the file through a temporary one in the same directory, so subscribers never get half of it.
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            f.write(content)
+        # mkstemp creates the file readable only by the owner, feeds are served to others
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def write_feeds(
+    config: dict[str, dict[str, str]],
+    events: list[Event],
+    unfetched: set[str] | None = None,
+) -> list[str]:
+    """
+    Writes an .ics file of every feed in [ics_feeds] into [sync] ics_dir.
+    A feed is rewritten only when the set of its events changed since it was last written,
+    the revisions of its events are kept in the state store along with it.
+    Feeds of the unfetched leagues are left as they are, their games are unknown.
+
+    Returns:
+        list[str]: paths of the feeds written now
+    """
+    targets = feed_targets(config)
+    if not targets:
+        return []
+    directory = config.get("sync", {}).get("ics_dir", DEFAULT_FEEDS_DIR)
+    store = get_store()
+    written = []
+    for name, tags in targets.items():
+        path = os.path.join(directory, f"{name}.ics")
+        if unfetched and tags & unfetched:
+            logger.warning(f"Keeping {path}, some of its leagues couldn't be fetched")
+            continue
+        feed_events = list(
+            dict.fromkeys(event for event in events if event.league in tags)
+        )
+        digest = events_hash(feed_events)
+        if store.get_value(f"ics_hash:{path}") == digest and os.path.exists(path):
+            continue
+        event_revisions = revisions(
+            feed_events, store.get_value(f"ics_revisions:{path}", {}), time.time()
+        )
+        try:
+            write_atomic(path, render_feed(name, feed_events, event_revisions))
+        except OSError as e:
+            logger.error(f"Couldn't write feed {path}: {e}")
+            continue
+        store.set_value(f"ics_revisions:{path}", event_revisions)
+        store.set_value(f"ics_hash:{path}", digest)
+        logger.info(f"Wrote {len(feed_events)} events to {path}")
+        written.append(path)
+    metrics.count("feeds_written", len(written))
+    return written
@@ -0,0 +1,506 @@
+from __future__ import annotations
+
+import hashlib
+import re
+import threading
+from datetime import date, datetime
+from functools import cached_property
+from typing import TYPE_CHECKING, Iterator
+from logger import Logger
+from http_cache import BlockCache
+from parser import ALL_TIME, HTML_FEATURES, MINSK_TZ, Event, Window
+
+# bs4 is imported by the first parse, runs that find every page unchanged don't need it
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup, SoupStrainer, Tag
+
+logger = Logger(__name__)
+
+Months = {
+    "янв": "01",
+    "фев": "02",
+    "мар": "03",
+    "апр": "04",
+    "мая": "05",
+    "июн": "06",
+    "июл": "07",
+    "авг": "08",
+    "сен": "09",
+    "окт": "10",
+    "ноя": "11",
+    "дек": "12",
+}
+
+# Arena names are changed for my convenience in the calendar, [arenas] in urls.ini adds more
+ARENAS = {
+    'Крытый каток ГУ ХК "Юность-Минск"': "Парк",
+    "Чижовка-Арена": "Чиж",
+    "Пристройка за Дворцом Спорта": "ДС",
+    "Олимпик Арена": "Олимп",
+    "Крытый Ледовый Каток Раубичи": "Рауб",
+    "Ледового Дворца спорта Минской области": "Прит",
+}
+
+SECTION_PREFIX = "league."
+
+# Leagues known without a config block, a [league.<name>] section in urls.ini changes their options
+# or describes a new league. Fields are column indexes of the row or CSS selectors inside it.
+BUILTIN_LEAGUES = {
+    "nhl": {
+        "tag": "сер",
+        # only the schedule containers are built into the tree, the rest of the page is skipped
+        "strainer": "div.timetable__unit.js-schedule-games-cont",
+        # hidden containers hold past games
+        "days": "div.timetable__unit.js-schedule-games-cont:not([style])",
+        "date": "span",
+        "date_format": "%d %B",
+        "rows": "li",
+        "skip": "div.timetable__score-main",
+        "skip_re": r"^\d+\s*-\s*\d+$",
+        "time": "span.timetable__time",
+        "arena": "span.timetable__place-name",
+        "teams": "div.timetable__middle div.timetable__team-name",
+        "block": r'<div[^>]+class="timetable__unit js-schedule-games-cont"',
+    },
+    "lhl": {
+        "tag": "коля",
+        "strainer": "tbody",
+        "rows": "tbody tr",
+        "date": "0",
+        "date_re": r"\d{1,2}\.\d{1,2}\.\d{4}",
+        "time": "1",
+        "arena": "2",
+        "team1": "3",
+        "team2": "5",
+        "blocks_from": "<tbody",
+        "block": r"<tr[\s>]",
+        "blocks_to": "</tbody>",
+        "block_wrap": "<table><tbody>{}</tbody></table>",
+    },
+    "alh": {
+        "tag": "АЛХ",
+        "strainer": "tr",
+        "strainer_class": r"^sectiontableentry\d$",
+        "rows": "tr",
+        "date": "2",
+        "time": "3",
+        "arena": "1",
+        "team1": "4",
+        "team2": "8",
+        "unknown_arena": "keep",
+        "block": r'<tr[^>]+class="sectiontableentry\d+"',
+        "block_wrap": "<table>{}</table>",
+    },
+}
+
+FIELDS = ("date", "time", "arena", "team1", "team2", "teams", "skip")
+# tag.class selectors are matched in one walk over the row instead of a selector match per field
+SIMPLE_SELECTOR_RE = re.compile(r"^([a-z][a-z0-9]*)\.([\w-]+)$")
+SELECTOR_STEP_RE = re.compile(
+    r"^([a-z][a-z0-9]*)?((?:\.[\w-]+)*)((?::not\(\[[\w-]+\]\))*)$"
+)
+NOT_ATTR_RE = re.compile(r":not\(\[([\w-]+)\]\)")
+MONTH_RE = re.compile(r"[^\W\d_]+")
+
+
+class Selector:
+    """
+    CSS selector compiled once. Descendant chains of tag.class:not([attr]) steps run as find_all
+    calls, which is several times faster than soupsieve matching, anything else goes to soupsieve.
+    Several classes of a step are matched as the whole class attribute like bs4 does.
+    """
+
+    def __init__(self, selector: str):
+        self.selector = selector
+        steps = [SELECTOR_STEP_RE.match(step) for step in selector.split()]
+        if steps and all(step and step.group(0) for step in steps):
+            self.steps = [
+                (step.group(1) or True, self._step_attrs(step)) for step in steps
+            ]
+            self.sieve = None
+        else:
+            import soupsieve
+
+            self.steps = None
+            self.sieve = soupsieve.compile(selector)
+
+    @staticmethod
+    def _step_attrs(step: re.Match) -> dict:
+        # bs4 matches an attribute filter of None only on tags without the attribute
+        attrs = {name: None for name in NOT_ATTR_RE.findall(step.group(3))}
+        if step.group(2):
+            attrs["class_"] = " ".join(step.group(2).split(".")[1:])
+        return attrs
+
+    def select(self, tag: Tag, limit: int = 0) -> list[Tag]:
+        if self.sieve is not None:
+            return self.sieve.select(tag, limit=limit)
+        found = [tag]
+        for name, attrs in self.steps[:-1]:
+            found = [
+                child for parent in found for child in parent.find_all(name, **attrs)
+            ]
+        name, attrs = self.steps[-1]
+        result = []
+        for parent in found:
+            result.extend(
+                parent.find_all(
+                    name, limit=limit - len(result) if limit else None, **attrs
+                )
+            )
+            if limit and len(result) >= limit:
+                break
+        return result
+
+    def select_one(self, tag: Tag) -> Tag | None:
+        found = self.select(tag, limit=1)
+        return found[0] if found else None
+
+
+class LeagueParser:
+    """
+    Parser of one league site built from its options: selectors are compiled once
+    and every league runs through the same extraction loop.
+
+    Options:
+        tag: league name shown in the calendar
+        strainer, strainer_class: tag.class of the containers built into the tree, regex of their class
+        days: selector of day blocks for sites that group games by day, date is then read from the block
+        rows: selector of game rows
+        cell: tag of the columns numbered by indexes, td by default
+        date, time, arena, team1, team2 or teams, skip: column index or selector of the field
+        date_re: regex cutting the date out of the text
+        date_format, time_format: strptime formats, %B stands for a Russian month name, year is
+            the current one if the format has none
+        skip_re: rows whose skip field matches are dropped, like played games with a score
+        unknown_arena: keep the name of an arena missing from the aliases or skip the game
+        block: regex of the start of a day or row in the raw page, blocks are fingerprinted to
+            extract only the changed ones, the whole page is parsed at once without it
+        blocks_from, blocks_to: regexes of where the blocks start and end on the page
+        block_wrap: markup a block is put into before parsing, {} stands for the block
+    """
+
+    def __init__(
+        self, name: str, options: dict[str, str], arenas: dict[str, str] = ARENAS
+    ):
+        self.name = name
+        self.tag = options.get("tag", name)
+        self.strainer_options = (options.get("strainer"), options.get("strainer_class"))
+        self.days = self._compile(options.get("days"))
+        # games grouped by day take the date from the day block
+        self.day_date = self._compile(options["date"]) if self.days else None
+        self.rows = self._compile(options["rows"])
+        self.cell = options.get("cell", "td")
+
+        self.columns: dict[str, int] = {}
+        self.simple: dict[tuple[str, str], str] = {}
+        self.selectors: dict[str, Selector] = {}
+        for field in FIELDS:
+            ref = options.get(field)
+            if not ref or (field == "date" and self.days):
+                continue
+            if ref.strip().isdigit():
+                self.columns[field] = int(ref)
+            elif field != "teams" and SIMPLE_SELECTOR_RE.match(ref.strip()):
+                self.simple[SIMPLE_SELECTOR_RE.match(ref.strip()).groups()] = field
+            else:
+                self.selectors[field] = self._compile(ref)
+        self.simple_tags = sorted({tag_name for tag_name, _ in self.simple})
+
+        self.date_re = (
+            re.compile(options["date_re"]) if options.get("date_re") else None
+        )
+        self.date_format = options.get("date_format", "%d.%m.%Y")
+        self.time_format = options.get("time_format", "%H:%M")
+        self.skip_re = (
+            re.compile(options["skip_re"]) if options.get("skip_re") else None
+        )
+        self.keep_unknown_arenas = options.get("unknown_arena", "skip") == "keep"
+        self.arenas = {name.casefold(): alias for name, alias in arenas.items()}
+
+        self.block_re = self._compile_re(options.get("block"))
+        self.blocks_from = self._compile_re(options.get("blocks_from"))
+        self.blocks_to = self._compile_re(options.get("blocks_to"))
+        self.block_wrap = options.get("block_wrap", "{}")
+        # blocks extracted with other options or aliases are extracted again
+        self.signature = hashlib.blake2b(
+            repr((sorted(options.items()), sorted(arenas.items()))).encode("utf-8"),
+            digest_size=8,
+        ).hexdigest()
+
+    @staticmethod
+    def _compile_re(pattern: str | None) -> re.Pattern | None:
+        return re.compile(pattern) if pattern else None
+
+    @staticmethod
+    def _compile(selector: str | None) -> Selector | None:
+        return Selector(selector) if selector else None
+
+    @cached_property
+    def strainer(self) -> SoupStrainer | None:
+        from bs4 import SoupStrainer
+
+        selector, class_re = self.strainer_options
+        if not selector:
+            return None
+        tag_name, *classes = selector.split(".")
+        if class_re:
+            return SoupStrainer(tag_name or None, class_=re.compile(class_re))
+        if classes:
+            return SoupStrainer(tag_name or None, class_=" ".join(classes))
+        return SoupStrainer(tag_name)
+
+    def _extract(self, row: Tag) -> dict[str, str | list[str] | None]:
+        values = {}
+        if self.columns:
+            cells = row.find_all(self.cell)
+            for field, index in self.columns.items():
+                values[field] = (
+                    cells[index].text.strip() if index < len(cells) else None
+                )
+        if self.simple:
+            for tag in row.find_all(self.simple_tags):
+                for class_name in tag.get("class") or ():
+                    field = self.simple.get((tag.name, class_name))
+                    if field is not None and field not in values:
+                        values[field] = tag.text.strip()
+                if len(values) == len(self.columns) + len(self.simple):
+                    break
+        for field, selector in self.selectors.items():
+            if field == "teams":
+                values[field] = [
+                    tag.text.strip() for tag in selector.select(row, limit=2)
+                ]
+            else:
+                tag = selector.select_one(row)
+                values[field] = tag.text.strip() if tag is not None else None
+        return values
+
+    def parse_date(self, text: str | None, year: int) -> date:
+        if not text:
+            raise ValueError("no date")
+        if self.date_re:
+            match = self.date_re.search(text)
+            if match is None:
+                raise ValueError(f"no date in {text!r}")
+            text = match.group(0)
+        date_format = self.date_format
+        if "%B" in date_format:
+            text = MONTH_RE.sub(lambda m: Months[m.group(0)[:3].lower()], text, count=1)
+            date_format = date_format.replace("%B", "%m")
+        if "%Y" not in date_format:
+            text, date_format = f"{text} {year}", f"{date_format} %Y"
+        return datetime.strptime(text, date_format).date()
+
+    def _event(self, values: dict, day: date) -> Event | None:
+        if self.skip_re and self.skip_re.match(values.get("skip") or ""):
+            return None
+        place = values.get("arena") or ""
+        arena = self.arenas.get(place.casefold())
+        if arena is None:
+            if not self.keep_unknown_arenas:
+                return None
+            arena = place
+        teams = values.get("teams") or [values.get("team1"), values.get("team2")]
+        team1, team2 = teams
+        start = datetime.strptime(values.get("time") or "", self.time_format).time()
+        return Event(
+            MINSK_TZ.localize(datetime.combine(day, start)),
+            arena,
+            self.tag,
+            f"{team1} vs {team2}",
+        )
+
+    def parse(
+        self,
+        html_content: str,
+        window: Window = ALL_TIME,
+        blocks: BlockCache | None = None,
+    ) -> Iterator[Event]:
+        """
+        Yields games of the league within the window.
+        With a block cache only the blocks missing from it are extracted, and the cache
+        gets games added to and removed from the window since its previous parse.
+        """
+        year = (window.start or datetime.now()).year
+        if blocks is not None and self.block_re is not None:
+            yield from self._parse_blocks(html_content, window, blocks, year)
+            return
+        from bs4 import BeautifulSoup
+
+        soup = BeautifulSoup(html_content, HTML_FEATURES, parse_only=self.strainer)
+        yield from self._walk(soup, window, year)
+
+    __call__ = parse
+
+    def _walk(self, soup: BeautifulSoup, window: Window, year: int) -> Iterator[Event]:
+        # day blocks are sorted, so whole days before the window are skipped and the walk stops after it
+        first_day = window.start.date() if window.start else None
+        last_day = window.end.date() if window.end else None
+
+        blocks = self.days.select(soup) if self.days else [soup]
+        for block in blocks:
+            day = None
+            if self.days:
+                date_tag = self.day_date.select_one(block)
+                try:
+                    day = self.parse_date(
+                        date_tag.text.strip() if date_tag else None, year
+                    )
+                except (ValueError, KeyError) as e:
+                    logger.error(f"Error parsing {self.name} day: {e}")
+                    continue
+                if first_day is not None and day < first_day:
+                    continue
+                if last_day is not None and day > last_day:
+                    break
+            for row in self.rows.select(block):
+                try:
+                    values = self._extract(row)
+                    row_day = (
+                        day
+                        if day is not None
+                        else self.parse_date(values.get("date"), year)
+                    )
+                    event = self._event(values, row_day)
+                except Exception as e:
+                    logger.error(f"Error parsing {self.name} games: {e}")
+                    continue
+                if (
+                    event is not None
+                    and not window.before(event.start)
+                    and not window.after(event.start)
+                ):
+                    yield event
+
+    def split_blocks(self, html_content: str) -> list[str]:
+        """
+        Cuts the raw page into blocks at every match of the block regex.
+        """
+        start, end = 0, len(html_content)
+        if self.blocks_from:
+            match = self.blocks_from.search(html_content)
+            if match is None:
+                return []
+            start = match.end()
+        if self.blocks_to:
+            match = self.blocks_to.search(html_content, start)
+            if match is not None:
+                end = match.start()
+        starts = [
+            match.start() for match in self.block_re.finditer(html_content, start, end)
+        ]
+        return [
+            html_content[begin:finish]
+            for begin, finish in zip(starts, starts[1:] + [end])
+        ]
+
+    def fingerprint(self, block: str, year: int) -> str:
+        # the year is filled into dates without one, so it is a part of the block too
+        return hashlib.blake2b(
+            f"{self.signature}|{year}|{block}".encode("utf-8"), digest_size=16
+        ).hexdigest()
+
+    def _parse_blocks(
+        self, html_content: str, window: Window, blocks: BlockCache, year: int
+    ) -> Iterator[Event]:
+        from bs4 import BeautifulSoup
+
+        last_day = window.end.date().isoformat() if window.end else None
+        extracted = 0
+        seen = set()
+        for block in self.split_blocks(html_content):
+            fingerprint = self.fingerprint(block, year)
+            data = blocks.get(fingerprint)
+            if data is None:
+                soup = BeautifulSoup(
+                    self.block_wrap.replace("{}", block),
+                    HTML_FEATURES,
+                    parse_only=self.strainer,
+                )
+                events = [event.to_json() for event in self._walk(soup, ALL_TIME, year)]
+                data = {
+                    "day": (
+                        max(event["dateTime"] for event in events)[:10]
+                        if events
+                        else None
+                    ),
+                    "events": events,
+                }
+                blocks.put(fingerprint, data)
+                extracted += 1
+            for event in data["events"]:
+                event = Event(**event)
+                if not window.before(event.start) and not window.after(event.start):
+                    seen.add(event)
+                    yield event
+            if self.days and last_day and data["day"] and data["day"] > last_day:
+                break
+
+        previous = {
+            event
+            for data in blocks.previous.values()
+            for event in map(lambda item: Event(**item), data["events"])
+            if not window.before(event.start) and not window.after(event.start)
+        }
+        blocks.added = list(seen - previous)
+        blocks.removed = list(previous - seen)
+        logger.debug(
+            f"{self.name}: extracted {extracted} blocks, reused {blocks.reused}, "
+            f"+{len(blocks.added)} -{len(blocks.removed)} events"
+        )
+
+
+def league_options(config: dict[str, dict[str, str]], league: str) -> dict[str, str]:
+    """
+    Returns built-in options of the league updated with its [league.<name>] section.
+    """
+    return {
+        **BUILTIN_LEAGUES.get(league, {}),
+        **config.get(f"{SECTION_PREFIX}{league}", {}),
+    }
+
+
+def build_registry(config: dict[str, dict[str, str]]) -> dict[str, LeagueParser]:
+    """
+    Compiles parsers of the built-in leagues and of every [league.<name>] section.
+    A league with broken options is logged and left out.
+    """
+    arenas = {**ARENAS, **config.get("arenas", {})}
+    names = list(BUILTIN_LEAGUES) + [
+        section[len(SECTION_PREFIX) :]
+        for section in config
+        if section.startswith(SECTION_PREFIX)
+        and section[len(SECTION_PREFIX) :] not in BUILTIN_LEAGUES
+    ]
+    registry = {}
+    for name in names:
+        try:
+            registry[name] = LeagueParser(name, league_options(config, name), arenas)
+        except Exception as e:
+            logger.error(f"Couldn't build parser of {name}: {e}")
+    return registry
+
+
+_registry: tuple[tuple, dict[str, LeagueParser]] | None = None
+_registry_lock = threading.Lock()
+
+
+def get_registry(config: dict[str, dict[str, str]]) -> dict[str, LeagueParser]:
+    """
+    Returns parsers of all leagues, compiled again only when their sections of the config change.
+    """
+    global _registry
+    key = tuple(
+        (section, tuple(sorted(options.items())))
+        for section, options in sorted(config.items())
+        if section.startswith(SECTION_PREFIX) or section == "arenas"
+    )
+    with _registry_lock:
+        if _registry is None or _registry[0] != key:
+            _registry = (key, build_registry(config))
+        return _registry[1]
+
+
+def get_parser(config: dict[str, dict[str, str]], league: str) -> LeagueParser | None:
+    return get_registry(config).get(league)
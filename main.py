@@ -1,46 +1,98 @@
-import parser as p
+import argparse
 import google_calendar_client as ggc
+from config import config_dict
+from ics_feed import write_feeds
 from logger import Logger
-import configparser
+import metrics
+import resilience
+from pipeline import (
+    expire_rejected_events,
+    fetch_events,
+    sync_window,
+    upcoming_events,
+)
 from datetime import datetime, timedelta
 
 logger = Logger(__name__)
 
 
-def import_ini_to_dict(file_path):
-    config = configparser.ConfigParser()
-    config.read(file_path)
-    return {section: dict(config[section]) for section in config.sections()}
-
-
-if __name__ == "__main__":
-    # Clear rejected events on wednesday and sunday to reask just in case
-    if (
-        datetime.now().isoweekday() == 3 or datetime.now().isoweekday() == 7
-    ) and 15 < datetime.now().hour < 17:
-        with open("rejected_events.json", "w") as f:
-            f.write("")
-
+def run_once(profile: bool = False, trace_memory: bool = False):
     logger.info(f"{'-' * 5}{datetime.now().strftime('%Y-%m-%d %H:%M')}{'-' * 59}")
-    urls = import_ini_to_dict("urls.ini")
-
-    service = ggc.get_calendar_service()
-    events = []
-    # events.extend(p.parse_events_lhl(urls['league_urls']['lhl']))
+    metrics.start_run("once", profile, trace_memory)
+    try:
+        urls = config_dict()
+        resilience.start_run_deadline(urls)
+        expire_rejected_events(urls)
 
-    events.extend(p.parse_events_nhl(urls["league_urls"]["nhl"]))
+        window = sync_window(urls)
+        events, unfetched = fetch_events(urls, window)
+        events = upcoming_events(events, window.start)
 
-    # events.extend(p.parse_events_alh(urls['league_urls']['alh']))
-
-    events = [
-        event
-        for event in events
-        if event.dateTime >= datetime.now().strftime(p.dt_format)
-    ]
-
-    ggc.refresh_calendar(service, urls["cals"], events)
-    # tel.send_notification()
+        write_feeds(urls, events, unfetched)
+        # feeds alone don't need the calendar
+        if urls.get("cals"):
+            service = ggc.get_calendar_service()
+            ggc.refresh_calendar(service, urls["cals"], events, window.end, unfetched)
+        # tel.send_notification()
+    finally:
+        resilience.start_deadline(None)
+        metrics.finish_run()
     logger.info("-" * 80)
     logger.clean_logs_up_to_date(
         (datetime.now() - timedelta(days=10)).strftime("%Y%m%d")
     )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Syncs hockey games from league sites to Google Calendar."
+    )
+    arg_parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and sync every league when it is due",
+    )
+    arg_parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="print when every league would be polled next and exit",
+    )
+    arg_parser.add_argument(
+        "--batch",
+        nargs="+",
+        metavar="DIR",
+        help="sync every directory with its own urls.ini, token.json and state, fetching each league page once",
+    )
+    arg_parser.add_argument(
+        "--workers",
+        type=int,
+        help="tenants of --batch synced at once, 4 by default",
+    )
+    arg_parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="run under cProfile and save the stats to Logs/profile_<time>.prof",
+    )
+    arg_parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="trace allocations with tracemalloc and add the peak and top sites to the run record",
+    )
+    args = arg_parser.parse_args()
+    if args.plan:
+        from pipeline import enabled_leagues
+        from scheduler import plan_poll
+
+        urls = config_dict()
+        for league in enabled_leagues(urls):
+            print(plan_poll(urls, league))
+    elif args.batch:
+        from batch import TENANT_WORKERS, run_batch
+
+        run_batch(args.batch, args.workers or TENANT_WORKERS)
+    elif args.daemon:
+        from daemon import Daemon
+
+        Daemon(args.profile, args.trace_memory).run()
+    else:
+        run_once(args.profile, args.trace_memory)
@@ -0,0 +1,198 @@
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from logger import Logger
+
+logger = Logger(__name__)
+
+RUNS_FILE = os.path.join("Logs", "runs.jsonl")
+PROFILE_FILE = os.path.join("Logs", "profile_{}.prof")
+MEMORY_TOP = 10  # allocation sites kept in the record of a run traced with tracemalloc
+
+
+class Run:
+    """
+    Timings and counters of one sync run, shared by all threads of the run.
+
+    Spans sum the seconds of every stage over the threads they ran in, so concurrent stages
+    may add up to more than the run took. HTTP traffic is counted by service: league sites,
+    calendar and telegram.
+    """
+
+    def __init__(self, mode: str, profile: bool = False, trace_memory: bool = False):
+        self.mode = mode
+        self.started = datetime.now()
+        self._clock = time.perf_counter()
+        self.spans: dict[str, list] = {}
+        self.http: dict[str, Counter] = {}
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        # cProfile sees only the thread that started the run
+        self.profiler = cProfile.Profile() if profile else None
+        self.trace_memory = trace_memory
+        if self.profiler is not None:
+            self.profiler.enable()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def add_span(self, name: str, seconds: float):
+        with self._lock:
+            entry = self.spans.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def add_request(self, service: str, sent: int, received: int, seconds: float):
+        with self._lock:
+            traffic = self.http.setdefault(service, Counter())
+            traffic["requests"] += 1
+            traffic["sent"] += sent
+            traffic["received"] += received
+            traffic["seconds"] += seconds
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    def finish(self) -> dict:
+        """
+        Stops the profilers and returns the record of the run.
+        """
+        seconds = time.perf_counter() - self._clock
+        record = {
+            "started": self.started.isoformat(timespec="seconds"),
+            "mode": self.mode,
+            "seconds": round(seconds, 3),
+            "spans": {
+                name: {"count": count, "seconds": round(total, 3)}
+                for name, (count, total) in sorted(self.spans.items())
+            },
+            "http": {
+                service: {
+                    key: round(value, 3) if key == "seconds" else value
+                    for key, value in traffic.items()
+                }
+                for service, traffic in sorted(self.http.items())
+            },
+            "counters": dict(sorted(self.counters.items())),
+        }
+        if self.profiler is not None:
+            self.profiler.disable()
+            path = PROFILE_FILE.format(self.started.strftime("%Y%m%d_%H%M%S"))
+            self.profiler.dump_stats(path)
+            record["profile"] = path
+        if self.trace_memory and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            record["memory"] = {
+                "peak_kb": peak // 1024,
+                "top": [
+                    f"{stat.traceback[0].filename}:{stat.traceback[0].lineno} {stat.size // 1024} KB"
+                    for stat in snapshot.statistics("lineno")[:MEMORY_TOP]
+                ],
+            }
+        return record
+
+
+_run = Run("process")
+_run_lock = threading.Lock()
+
+
+def start_run(mode: str, profile: bool = False, trace_memory: bool = False) -> Run:
+    """
+    Starts collecting timings and counters of a new run, optionally under cProfile and tracemalloc.
+    """
+    global _run
+    with _run_lock:
+        _run = Run(mode, profile, trace_memory)
+        return _run
+
+
+def current_run() -> Run:
+    return _run
+
+
+@contextmanager
+def span(name: str):
+    """
+    Times the block, or the function when used as a decorator, into the span of the current run.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _run.add_span(name, time.perf_counter() - started)
+
+
+def count(name: str, n: int = 1):
+    _run.count(name, n)
+
+
+def count_request(service: str, sent: int, received: int, seconds: float):
+    _run.add_request(service, sent, received, seconds)
+
+
+def response_hook(service: str):
+    """
+    Returns a requests response hook counting the traffic of a session into the service.
+    """
+
+    def hook(response, *args, **kwargs):
+        body = response.request.body
+        count_request(
+            service,
+            len(body) if body else 0,
+            len(response.content or b""),
+            response.elapsed.total_seconds(),
+        )
+
+    return hook
+
+
+def summary(record: dict) -> str:
+    """
+    Returns the record of a run as one line: stage times, traffic by service and counters.
+    """
+    parts = [f"{record['mode']} run took {record['seconds']:.2f}s"]
+    if record["spans"]:
+        parts.append(
+            ", ".join(
+                f"{name} {span['seconds']:.2f}s"
+                for name, span in record["spans"].items()
+            )
+        )
+    if record["http"]:
+        parts.append(
+            ", ".join(
+                f"{service} {traffic['requests']} requests {(traffic['sent'] + traffic['received']) // 1024} KB"
+                for service, traffic in record["http"].items()
+            )
+        )
+    if record["counters"]:
+        parts.append(
+            ", ".join(f"{name} {value}" for name, value in record["counters"].items())
+        )
+    return " | ".join(parts)
+
+
+def finish_run() -> dict:
+    """
+    Ends the current run, appends its record to Logs/runs.jsonl and logs the summary.
+    """
+    global _run
+    with _run_lock:
+        run, _run = _run, Run("process")
+    record = run.finish()
+    try:
+        with open(RUNS_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError as e:
+        logger.error(f"Couldn't write the run record: {e}")
+    logger.info(summary(record))
+    return record
@@ -1,60 +1,105 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, FrozenInstanceError
+from typing import Callable, Iterator
 import requests
-from bs4 import BeautifulSoup
 from datetime import datetime
 from logger import Logger
-import re
+from http_cache import HttpCache, body_hash
+import metrics
+import resilience
+import threading
+from urllib.parse import urlsplit
 import pytz
-from babel.dates import format_datetime
 
 logger = Logger(__name__)
 
 dt_format = "%Y-%m-%dT%H:%M:%S+03:00"
 
-Months = {
-    "янв": "01",
-    "фев": "02",
-    "мар": "03",
-    "апр": "04",
-    "мая": "05",
-    "июн": "06",
-    "июл": "07",
-    "авг": "08",
-    "сен": "09",
-    "окт": "10",
-    "ноя": "11",
-    "дек": "12",
-}
+MINSK_TZ = pytz.timezone("Europe/Minsk")
 
-# Arena names are changed for my convenience in the calendar
-ARENAS = {
-    'Крытый каток ГУ ХК "Юность-Минск"': "Парк",
-    "Чижовка-Арена": "Чиж",
-    "Пристройка за Дворцом Спорта": "ДС",
-    "Олимпик Арена": "Олимп",
-    "Крытый Ледовый Каток Раубичи": "Рауб",
-    "Ледового Дворца спорта Минской области": "Прит",
-}
+try:
+    import lxml  # noqa: F401
+
+    HTML_FEATURES = "lxml"
+except ImportError:
+    HTML_FEATURES = "html.parser"
 
 
-@dataclass
 class Event:
-    dateTime: datetime | None = None
-    arena: str | None = None
-    league: str | None = None
-    teams: str | None = None
+    """
+    Game parsed from a league site or read from the calendar.
+
+    Start time is kept as an aware datetime in Minsk time, the string form in dateTime is the one
+    used by the calendar and rejected_events.json. Events are immutable and compared by start time and teams.
+    """
+
+    __slots__ = (
+        "start",
+        "dateTime",
+        "arena",
+        "league",
+        "teams",
+        "_key",
+        "_hash",
+        "_display",
+    )
+
+    def __init__(
+        self,
+        dateTime: datetime | str | None = None,
+        arena: str | None = None,
+        league: str | None = None,
+        teams: str | None = None,
+    ):
+        if isinstance(dateTime, datetime):
+            start = dateTime.astimezone(MINSK_TZ)
+            date_str = start.strftime(dt_format)
+        else:
+            start = parse_datetime(dateTime)
+            date_str = dateTime
+        key = (start if start is not None else date_str, teams)
+        set_slot = object.__setattr__
+        set_slot(self, "start", start)
+        set_slot(self, "dateTime", date_str)
+        set_slot(self, "arena", arena)
+        set_slot(self, "league", league)
+        set_slot(self, "teams", teams)
+        set_slot(self, "_key", key)
+        set_slot(self, "_hash", hash(key))
+        set_slot(self, "_display", None)
+
+    def __setattr__(self, name, value):
+        raise FrozenInstanceError(f"cannot assign to field '{name}'")
+
+    def __delattr__(self, name):
+        raise FrozenInstanceError(f"cannot delete field '{name}'")
+
+    def __reduce__(self):
+        return Event, (self.dateTime, self.arena, self.league, self.teams)
 
     def __eq__(self, other):
-        return self.dateTime == other.dateTime and self.teams == other.teams
+        if not isinstance(other, Event):
+            return NotImplemented
+        return self._key == other._key
 
     def __repr__(self):
         return f"{self.arena} {self.league} {self.dateTime} {self.teams}"
 
     def __str__(self):
-        return f"{format_datetime(datetime.strptime(self.dateTime, dt_format), 'EEEE, dd.MM HH:mm', locale='ru_RU')} {self.arena} {self.league} {self.teams}"
+        if self._display is None:
+            # babel is only needed for messages, it is imported on the first one
+            from babel.dates import format_datetime
+
+            # babel treats naive datetimes as wall time, aware ones would be shown in UTC
+            date = format_datetime(
+                self.start.replace(tzinfo=None), "EEEE, dd.MM HH:mm", locale="ru_RU"
+            )
+            object.__setattr__(
+                self, "_display", f"{date} {self.arena} {self.league} {self.teams}"
+            )
+        return self._display
 
     def __hash__(self):
-        return hash((self.dateTime, self.teams))
+        return self._hash
 
     def to_json(self):
         return {
@@ -65,153 +110,239 @@ class Event:
         }
 
 
-def fetch_html(url: str) -> str | None:
-    """Fetches HTML content from the given URL."""
+def parse_datetime(date_str: str | None) -> datetime | None:
+    """
+    Parses the start time of the event, None if it is empty or not a datetime.
+    """
+    if not date_str:
+        return None
     try:
-        # Header to mimic browser request to bypass captcha
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-            "Accept-Language": "en-US,en;q=0.9,ru;q=0.8",
-            "Accept-Encoding": "gzip, deflate, br",
-            "Connection": "keep-alive",
-            "Upgrade-Insecure-Requests": "1",
-            "Sec-Fetch-Dest": "document",
-            "Sec-Fetch-Mode": "navigate",
-            "Sec-Fetch-Site": "none",
-            "Cache-Control": "max-age=0",
-        }
-        response = requests.get(url, headers=headers, timeout=30)
-        response.raise_for_status()
-        return response.text
-    except requests.RequestException as e:
-        logger.error(f"Error fetching URL {url}: {e}", exc_info=True)
+        return datetime.fromisoformat(date_str)
+    except ValueError:
         return None
 
 
-def parse_events_lhl(url: str) -> list[Event]:
-    events = []
-    html_content = fetch_html(url)
+@dataclass(frozen=True)
+class Window:
+    """
+    Time window the parsers keep events from, open on a side that is None.
+    """
+
+    start: datetime | None = None
+    end: datetime | None = None
+
+    def before(self, dt: datetime) -> bool:
+        return self.start is not None and dt < self.start
+
+    def after(self, dt: datetime) -> bool:
+        return self.end is not None and dt > self.end
+
+    def tag(self) -> str:
+        # parses with different ends keep different events, the start only drops past ones
+        return f"|{self.end.isoformat()}" if self.end else ""
+
+
+ALL_TIME = Window()
+
+
+HEADERS = {
+    # Header to mimic browser request to bypass captcha
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.9,ru;q=0.8",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Connection": "keep-alive",
+    "Upgrade-Insecure-Requests": "1",
+    "Sec-Fetch-Dest": "document",
+    "Sec-Fetch-Mode": "navigate",
+    "Sec-Fetch-Site": "none",
+    "Cache-Control": "max-age=0",
+}
+
+DEFAULT_TIMEOUT = 30
+
+http_cache = HttpCache()
+
+_sessions: dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url: str) -> requests.Session:
+    """
+    Returns a keep-alive session shared by all requests to the host of the url.
+    """
+    host = urlsplit(url).netloc
+    with _sessions_lock:
+        if host not in _sessions:
+            session = requests.Session()
+            session.headers.update(HEADERS)
+            session.hooks["response"].append(metrics.response_hook("sites"))
+            _sessions[host] = session
+        return _sessions[host]
 
-    if not html_content:
-        return events
 
-    soup = BeautifulSoup(html_content, "html.parser")
-    event_elements = soup.find("tbody").find_all("tr")
+@dataclass
+class Page:
+    html: str
+    changed: bool = True
+
 
-    for element in event_elements:
+def fetch_page(url: str, timeout: float = DEFAULT_TIMEOUT) -> Page | None:
+    """
+    Fetches the page with a conditional GET against the on-disk cache.
+    Connection errors, timeouts, 429 and 5xx answers are retried with backoff within the timeout,
+    a host that keeps failing is skipped by the circuit breaker until it cools down. Requests cut short
+    by the run deadline don't count as failures of the host, and none are made once it passed.
+
+    Returns:
+        Page: body of the page and whether it differs from the cached copy, None on error
+    """
+    host = urlsplit(url).netloc
+    if not resilience.breaker.allow(host):
+        logger.warning(f"{host} keeps failing, skipping {url}")
+        return None
+    retry = resilience.Retry(budget=timeout)
+    cached = http_cache.get(url)
+    while True:
+        if resilience.remaining() == 0:
+            logger.error(f"Run deadline passed, {url} not fetched")
+            return None
         try:
-            info = element.find_all("td")
-            date = info[0].text[:-5]
-            time = info[1].text
-            arena = ARENAS[info[2].text.strip()]
-            team1 = info[3].text.strip()
-            team2 = info[5].text.strip()
-            dt = datetime.strptime(f"{date.strip()} {time.strip()}", "%d.%m.%Y %H:%M")
-            dt = pytz.timezone("Europe/Minsk").localize(dt).strftime(dt_format)
-            events.append(Event(dt, arena, "коля", f"{team1} vs {team2}"))
-        except Exception as e:
-            logger.error(f"Error parsing lhl games: {e}")
-        continue
-
-    return events
-
-
-def parse_events_nhl(url: str) -> list[Event]:
-    events = []
-    html_content = fetch_html(url)
-
-    if not html_content:
-        logger.info("No HTML content for nhl games")
-        return events
-
-    soup = BeautifulSoup(html_content, "html.parser")
-    # last_games = soup.find('div', class_="timetable__unit js-schedule-games-cont", style="display: none;")
-    event_elements = soup.find_all(
-        "div", class_="timetable__unit js-schedule-games-cont", style=None
-    )
-    #    event_elements = [event for event in event_elements if re.search(r'^\D', event.find('div', class_="timetable__score-main").text.strip())]
+            response = get_session(url).get(
+                url,
+                headers=http_cache.conditional_headers(url, cached),
+                timeout=retry.timeout(timeout),
+            )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            logger.warning(f"Error fetching URL {url}: {e}")
+            if retry.wait():
+                continue
+            if not retry.cut_short:
+                resilience.breaker.failure(host)
+            return None
+        except requests.RequestException as e:
+            logger.error(f"Error fetching URL {url}: {e}")
+            return None
+        if response.status_code in resilience.RETRY_STATUSES and retry.wait(
+            resilience.retry_after(response.headers.get("Retry-After"))
+        ):
+            logger.warning(f"{url} answered {response.status_code}, retrying")
+            continue
+        break
+
+    if response.status_code == 304 and cached:
+        logger.debug(f"{url} not modified")
+        resilience.breaker.success(host)
+        return Page(cached["body"], changed=False)
     try:
-        for unit_date in event_elements:
-            date_span = unit_date.find("span")
+        response.raise_for_status()
+    except requests.RequestException as e:
+        logger.error(f"Error fetching URL {url}: {e}")
+        if response.status_code in resilience.RETRY_STATUSES:
+            resilience.breaker.failure(host)
+        return None
+    resilience.breaker.success(host)
 
-            date_str = (
-                date_span.text.strip().split(" ")
-                if date_span and date_span.text.strip() != "(не задано)"
-                else None
-            )
-            date = (
-                datetime.now().strftime("%Y")
-                + "."
-                + Months[date_str[1][:3]]
-                + "."
-                + date_str[0]
-                if date_str
-                else None
+    html = response.text
+    digest = body_hash(html)
+    changed = not cached or cached.get("body_hash") != digest
+    entry = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "body_hash": digest,
+        "body": html,
+    }
+    if not changed:
+        entry["events"] = cached.get("events")
+        entry["events_hash"] = cached.get("events_hash")
+    http_cache.put(url, entry)
+    return Page(html, changed)
+
+
+def fetch_html(url: str) -> str | None:
+    """Fetches HTML content from the given URL."""
+    page = fetch_page(url)
+    return page.html if page else None
+
+
+def fetch_and_parse(
+    url: str,
+    parse: Callable[..., Iterator[Event]],
+    timeout: float = DEFAULT_TIMEOUT,
+    window: Window = ALL_TIME,
+) -> tuple[list[Event], bool] | None:
+    """
+    Fetches the url and parses events within the window with the given parser.
+    Skips the parse and returns the previous result if the page didn't change since the last fetch,
+    it may still hold events that started since then. A changed page is parsed block by block,
+    only blocks that changed since the previous parse are extracted. If the page couldn't be fetched,
+    events of its last parse are returned as unchanged.
+
+    Returns:
+        tuple[list[Event], bool]: parsed events and whether any event was added or removed,
+            None if the page couldn't be fetched and was never parsed
+    """
+    with metrics.span("fetch"):
+        page = fetch_page(url, timeout)
+    if page is None:
+        events = last_parse(url, window)
+        if events is None:
+            return None
+        # games missing from a failed fetch would be deleted from the calendar
+        logger.warning(
+            f"{url} unavailable, using {len(events)} events of its last parse"
+        )
+        return events, False
+    if not page.changed:
+        cached_events = http_cache.load_events(url, window.tag())
+        if cached_events is not None:
+            logger.debug(f"{url} unchanged, reusing {len(cached_events)} parsed events")
+            http_cache.record_fetch(url, changed=False)
+            return [Event(**event) for event in cached_events], False
+    with metrics.span("parse"):
+        blocks = http_cache.load_blocks(url)
+        events = list(parse(page.html, window, blocks))
+        events_json = [event.to_json() for event in events]
+        http_cache.store_events(url, events_json, window.tag())
+    if blocks.current:
+        http_cache.store_blocks(blocks)
+        changed = bool(blocks.added or blocks.removed)
+        if changed:
+            logger.info(
+                f"{url}: {len(blocks.added)} events added, {len(blocks.removed)} removed"
             )
-            if date < datetime.now().strftime("%Y.%m.%d"):
-                continue
-            games = unit_date.find_all("li")
-            for game in games:
-                if re.match(
-                    r"^\d+\s*-\s*\d+$",
-                    game.find("div", class_="timetable__score-main").text.strip(),
-                ):
-                    continue
-                time = (
-                    game.find("span", class_="timetable__time").text.strip()
-                    if game.find("span", class_="timetable__time")
-                    and game.find("span", class_="timetable__time").text
-                    != "(не задано)"
-                    else None
-                )
-                place = game.find("span", class_="timetable__place-name").text.strip()
-                arena = (
-                    ARENAS[place if place and place != "(не задано)" else "Хз"]
-                    if place in ARENAS
-                    else None
-                )
-                team1, team2 = (
-                    x.text.strip()
-                    for x in game.find("div", class_="timetable__middle").find_all(
-                        "div", class_="timetable__team-name"
-                    )
-                )
-                dt = datetime.strptime(
-                    f"{date.strip()} {time.strip()}", "%Y.%m.%d %H:%M"
-                )
-                dt = pytz.timezone("Europe/Minsk").localize(dt).strftime(dt_format)
-                if arena is not None:
-                    events.append(Event(dt, arena, "сер", f"{team1} vs {team2}"))
-        return events
-    except Exception as e:
-        logger.error(f"Error parsing nhl games: {e}")
-        return events
-
-
-def parse_events_alh(url: str) -> list[Event]:
-    events = []
-    html_content = fetch_html(url)
-    if not html_content:
-        return events
-
-    soup = BeautifulSoup(html_content, "html.parser")
-    event_elements = soup.find_all("tr", class_=re.compile(r"^sectiontableentry\d$"))
-
-    for element in event_elements:
-        try:
-            info = element.find_all("td")
-            date = info[2].text.strip() if info[0] else None
-            time = info[3].text.strip() if info[1] else None
-            arena = info[1].text.strip() if info[2] else None
-            arena = ARENAS[arena] if arena in ARENAS else arena
-            team1 = info[4].text.strip() if info[3] else None
-            team2 = info[8].text.strip() if info[5] else None
-            dt = datetime.strptime(f"{date.strip()} {time.strip()}", "%d.%m.%Y %H:%M")
-            dt = pytz.timezone("Europe/Minsk").localize(dt).strftime(dt_format)
-            events.append(Event(dt, arena, "АЛХ", f"{team1} vs {team2}"))
-        except Exception as e:
-            logger.error(f"Error parsing alh games: {e}")
-        continue
-
-    return events
+    else:
+        # the parser has no blocks, the events are compared as a whole
+        changed = http_cache.events_changed(url, events_json)
+    # the poll schedule backs off on games that stay the same, not on markup
+    http_cache.record_fetch(url, changed)
+    return events, changed
+
+
+def last_parse(url: str, window: Window = ALL_TIME) -> list[Event] | None:
+    """
+    Returns events within the window from the last parse of the url, None if it was never parsed.
+    """
+    cached_events = http_cache.load_events(url, window.tag())
+    if cached_events is None:
+        cached_events = http_cache.load_events(url, tag=None)
+    if cached_events is None:
+        return None
+    events = [Event(**event) for event in cached_events]
+    return [
+        event
+        for event in events
+        if event.start is not None
+        and not window.before(event.start)
+        and not window.after(event.start)
+    ]
+
+
+def parse_cached(
+    url: str,
+    parse: Callable[..., Iterator[Event]],
+    timeout: float = DEFAULT_TIMEOUT,
+    window: Window = ALL_TIME,
+) -> list[Event] | None:
+    result = fetch_and_parse(url, parse, timeout, window)
+    return result[0] if result else None
@@ -0,0 +1,214 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+import time
+from typing import Callable, Hashable, Iterator
+from datetime import datetime, timedelta
+import parser as p
+from parser import Event, Window
+from leagues import get_parser, get_registry
+from logger import Logger
+import resilience
+from storage import get_store
+
+logger = Logger(__name__)
+
+DEFAULT_LEAGUES = ["nhl"]
+
+# rejected games are asked about again after this many seconds
+REJECTED_TTL = 3.5 * 24 * 60 * 60
+
+
+def enabled_leagues(config: dict[str, dict[str, str]]) -> list[str]:
+    """
+    Returns leagues listed in [sync] leagues, only nhl if the option is missing.
+    """
+    leagues = config.get("sync", {}).get("leagues")
+    if not leagues:
+        return DEFAULT_LEAGUES
+    return [league.strip().lower() for league in leagues.split(",") if league.strip()]
+
+
+def sync_window(
+    config: dict[str, dict[str, str]], now: datetime | None = None
+) -> Window:
+    """
+    Returns the window of games to sync: from now up to the end of the day [sync] horizon_days ahead,
+    open-ended if the option is missing. The end is rounded to midnight so parses within a day share a cache.
+    """
+    if now is None:
+        now = datetime.now(p.MINSK_TZ)
+    horizon = config.get("sync", {}).get("horizon_days")
+    if not horizon:
+        return Window(now)
+    end = (now + timedelta(days=float(horizon) + 1)).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    return Window(now, p.MINSK_TZ.localize(end.replace(tzinfo=None)))
+
+
+def league_timeout(config: dict[str, dict[str, str]], league: str) -> float:
+    """
+    Returns the fetch timeout of the league from [league_timeouts], default timeout if not set.
+    """
+    return float(config.get("league_timeouts", {}).get(league, p.DEFAULT_TIMEOUT))
+
+
+def fetch_league(
+    config: dict[str, dict[str, str]], league: str, window: Window = p.ALL_TIME
+) -> tuple[list[Event], bool] | None:
+    """
+    Fetches and parses games of one league within the window.
+
+    Returns:
+        tuple[list[Event], bool]: events and whether the page changed, None if the league couldn't be fetched
+    """
+    url = config.get("league_urls", {}).get(league)
+    parse = get_parser(config, league)
+    if parse is None or not url:
+        logger.warning(f"League {league} has no parser or url, skipping")
+        return None
+    return p.fetch_and_parse(url, parse, league_timeout(config, league), window)
+
+
+def upcoming_events(events: list[Event], now: datetime | None = None) -> list[Event]:
+    """
+    Drops events that already started, parses reused from the cache may still have them.
+    """
+    if now is None:
+        now = datetime.now(p.MINSK_TZ)
+    return [event for event in events if event.start is not None and event.start >= now]
+
+
+def expire_rejected_events(config: dict[str, dict[str, str]]):
+    """
+    Forgets old rejections to ask about those games again just in case.
+    """
+    max_age = float(config.get("sync", {}).get("rejected_ttl", REJECTED_TTL))
+    expired = get_store().expire_rejected_events(max_age)
+    if expired:
+        logger.info(f"Forgot {expired} rejected events")
+
+
+def last_events(url: str, league: str, window: Window) -> list[Event] | None:
+    """
+    Returns events of the last parse of the league, None if it was never parsed.
+    """
+    events = p.last_parse(url, window)
+    if events is not None:
+        logger.warning(f"Using {len(events)} {league} events of its last parse")
+    return events
+
+
+@dataclass(frozen=True)
+class FetchJob:
+    """
+    Page of a league to fetch and the parser of it.
+    """
+
+    league: str
+    url: str
+    parse: Callable[..., Iterator[Event]]
+    timeout: float = p.DEFAULT_TIMEOUT
+
+
+def league_jobs(config: dict[str, dict[str, str]]) -> dict[str, FetchJob]:
+    """
+    Returns fetch jobs of the enabled leagues that have a parser and an url.
+    """
+    league_urls = config.get("league_urls", {})
+    registry = get_registry(config)
+    jobs = {}
+    for league in enabled_leagues(config):
+        if league not in registry or league not in league_urls:
+            logger.warning(f"League {league} has no parser or url, skipping")
+            continue
+        jobs[league] = FetchJob(
+            league,
+            league_urls[league],
+            registry[league],
+            league_timeout(config, league),
+        )
+    return jobs
+
+
+def fetch_jobs(
+    jobs: dict[Hashable, FetchJob], window: Window = p.ALL_TIME
+) -> dict[Hashable, list[Event] | None]:
+    """
+    Fetches and parses the pages of the jobs within the window concurrently.
+
+    Every page is fetched over the session of its host and parsed as soon as it arrives.
+    A job that doesn't finish within its timeout or the run deadline gets the events of its last parse,
+    so its games are not deleted from the calendar, and None if it was never parsed.
+
+    Returns:
+        dict: events by the key of the job
+    """
+    results = {key: None for key in jobs}
+    if not jobs:
+        return results
+
+    pool = ThreadPoolExecutor(max_workers=len(jobs))
+    started = time.monotonic()
+    pending = {
+        pool.submit(p.parse_cached, job.url, job.parse, job.timeout, window): key
+        for key, job in jobs.items()
+    }
+    run_left = resilience.remaining()
+    while pending:
+        # requests timeout limits single socket operations, so every job also gets a deadline
+        deadlines = {
+            future: (
+                started + jobs[key].timeout
+                if run_left is None
+                else started + min(jobs[key].timeout, run_left)
+            )
+            for future, key in pending.items()
+        }
+        done, _ = wait(
+            pending,
+            timeout=max(0, min(deadlines.values()) - time.monotonic()),
+            return_when=FIRST_COMPLETED,
+        )
+        for future in done:
+            key = pending.pop(future)
+            job = jobs[key]
+            try:
+                results[key] = future.result()
+                if results[key] is not None:
+                    logger.info(f"Parsed {len(results[key])} {job.league} events")
+            except Exception as e:
+                logger.error(f"Couldn't fetch {job.league} events: {e}", exc_info=True)
+                results[key] = last_events(job.url, job.league, window)
+        for future, deadline in deadlines.items():
+            if future in pending and deadline <= time.monotonic():
+                key = pending.pop(future)
+                logger.error(f"Timed out fetching {jobs[key].league} events")
+                results[key] = last_events(jobs[key].url, jobs[key].league, window)
+    pool.shutdown(wait=False, cancel_futures=True)
+    return results
+
+
+def unfetched_tags(
+    jobs: dict[Hashable, FetchJob], results: dict[Hashable, list[Event] | None]
+) -> set[str]:
+    """
+    Returns tags of the leagues that couldn't be fetched and were never parsed.
+    Their games are unknown, so the calendars and feeds keep what they have of them.
+    """
+    return {jobs[key].parse.tag for key, events in results.items() if events is None}
+
+
+def fetch_events(
+    config: dict[str, dict[str, str]], window: Window = p.ALL_TIME
+) -> tuple[list[Event], set[str]]:
+    """
+    Fetches and parses games within the window of all enabled leagues concurrently, see fetch_jobs.
+
+    Returns:
+        tuple[list[Event], set[str]]: events of all leagues and tags of the leagues that couldn't be fetched
+    """
+    jobs = league_jobs(config)
+    results = fetch_jobs(jobs, window)
+    events = [event for events in results.values() if events for event in events]
+    return events, unfetched_tags(jobs, results)
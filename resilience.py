@@ -0,0 +1,185 @@
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from logger import Logger
+from storage import get_store
+
+logger = Logger(__name__)
+
+RETRIES = 3
+BASE_DELAY = 1.0  # seconds before the first retry, doubled for every next one
+MAX_DELAY = 60.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# a host failing this many calls in a row is skipped for COOLDOWN seconds
+FAILURE_THRESHOLD = 3
+COOLDOWN = 10 * 60
+
+DEFAULT_RUN_DEADLINE = 10 * 60
+
+_deadline: float | None = None
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Unavailable(Exception):
+    """
+    Raised instead of calling a host the circuit breaker keeps closed.
+    """
+
+
+def start_deadline(seconds: float | None = DEFAULT_RUN_DEADLINE):
+    """
+    Sets the time the current run has to finish in, calls started after it fail fast. None removes the limit.
+    """
+    global _deadline
+    _deadline = time.monotonic() + seconds if seconds else None
+
+
+def start_run_deadline(config: dict[str, dict[str, str]]):
+    """
+    Starts the deadline of a run from [sync] run_deadline, 0 runs without one.
+    """
+    start_deadline(
+        float(config.get("sync", {}).get("run_deadline", DEFAULT_RUN_DEADLINE))
+    )
+
+
+def remaining() -> float | None:
+    """
+    Returns seconds left until the run deadline, None if the run has no deadline.
+    """
+    if _deadline is None:
+        return None
+    return max(0.0, _deadline - time.monotonic())
+
+
+def check_deadline(what: str):
+    if _deadline is not None and time.monotonic() >= _deadline:
+        raise DeadlineExceeded(f"Run deadline passed before {what}")
+
+
+def retry_after(value: str | None) -> float | None:
+    """
+    Parses a Retry-After header, given in seconds or as an HTTP date.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class Retry:
+    """
+    Attempts of one call: retries wait a jittered exponential delay, or as long as the server
+    asked with Retry-After, and stop once the wait would run past the budget of the call or the run deadline.
+    """
+
+    def __init__(self, retries: int = RETRIES, budget: float | None = None):
+        self.retries = retries
+        self.attempt = 0
+        self.until = time.monotonic() + budget if budget is not None else None
+        # the last timeout was shortened by the run deadline, its failure says nothing about the host
+        self.cut_short = False
+
+    def _left(self) -> float | None:
+        limits = [limit for limit in (self.until, _deadline) if limit is not None]
+        return max(0.0, min(limits) - time.monotonic()) if limits else None
+
+    def timeout(self, timeout: float) -> float:
+        """
+        Bounds the timeout of the next attempt by the time left.
+        """
+        left = self._left()
+        run_left = remaining()
+        self.cut_short = run_left is not None and run_left < timeout
+        return timeout if left is None else max(0.1, min(timeout, left))
+
+    def wait(self, delay: float | None = None) -> bool:
+        """
+        Sleeps before the next attempt.
+
+        Args:
+            delay: seconds the server asked to wait, a backoff delay if None
+
+        Returns:
+            bool: False if no attempts are left or there is no time for another one
+        """
+        if self.attempt >= self.retries:
+            return False
+        if delay is None:
+            delay = min(MAX_DELAY, BASE_DELAY * 2**self.attempt) * random.uniform(
+                0.5, 1.0
+            )
+        left = self._left()
+        if left is not None and delay >= left:
+            return False
+        self.attempt += 1
+        time.sleep(delay)
+        return True
+
+
+class CircuitBreaker:
+    """
+    Counts failed calls by host in the state store, so cron runs share them. A host that failed
+    FAILURE_THRESHOLD times in a row is skipped until COOLDOWN passes, then a single call is let through
+    to check it, which closes the breaker on success and opens it again on failure. Other calls are
+    skipped while the check runs, and another one is let through if it hasn't finished within COOLDOWN.
+    """
+
+    def __init__(self, threshold: int = FAILURE_THRESHOLD, cooldown: float = COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(host: str) -> str:
+        return f"breaker:{host}"
+
+    def allow(self, host: str) -> bool:
+        state = get_store().get_value(self._key(host))
+        if not state or state["failures"] < self.threshold:
+            return True
+        with self._lock:
+            state = get_store().get_value(self._key(host))
+            if not state or state["failures"] < self.threshold:
+                return True
+            if time.time() - state["opened_at"] < self.cooldown:
+                return False
+            # this call is the check, the next one waits for its outcome or another cooldown
+            state["opened_at"] = time.time()
+            get_store().set_value(self._key(host), state)
+            return True
+
+    def success(self, host: str):
+        with self._lock:
+            if get_store().get_value(self._key(host)):
+                get_store().set_value(self._key(host), None)
+                logger.info(f"{host} is available again")
+
+    def failure(self, host: str):
+        with self._lock:
+            state = get_store().get_value(self._key(host)) or {"failures": 0}
+            state["failures"] += 1
+            if state["failures"] >= self.threshold:
+                state["opened_at"] = time.time()
+                logger.warning(
+                    f"{host} failed {state['failures']} times in a row, skipping it for {self.cooldown:.0f}s"
+                )
+            get_store().set_value(self._key(host), state)
+
+
+breaker = CircuitBreaker()
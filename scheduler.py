@@ -0,0 +1,141 @@
+import time
+from dataclasses import dataclass
+from datetime import datetime
+import parser as p
+from logger import Logger
+
+logger = Logger(__name__)
+
+DEFAULT_INTERVAL = 15 * 60  # seconds between polls of a league
+MIN_INTERVAL = 5 * 60
+MAX_INTERVAL = 6 * 60 * 60
+# the interval doubles after this many fetches in a row that found no changes
+BACKOFF_STEP = 4
+# after a change the page is polled often for a while, the schedule tends to change in bursts
+HOT_WINDOW = 60 * 60
+# games this close keep the league on the base interval, late reschedules matter most
+GAME_WINDOW = 24 * 60 * 60
+# a league running out of known games is about to publish the next round
+ROUND_WINDOW = 3 * 24 * 60 * 60
+# more changes per day than this keep the league on the base interval
+VOLATILE_CHANGES_PER_DAY = 1.0
+HISTORY_WINDOW = 7 * 24 * 60 * 60
+
+
+@dataclass
+class PollPlan:
+    league: str
+    next_poll: float
+    interval: float
+    reason: str
+
+    def __str__(self):
+        when = datetime.fromtimestamp(self.next_poll).strftime("%Y-%m-%d %H:%M")
+        return f"{self.league}: next poll {when} (every {int(self.interval)}s, {self.reason})"
+
+
+def _setting(config: dict[str, dict[str, str]], name: str, default: float) -> float:
+    return float(config.get("daemon", {}).get(name, default))
+
+
+def base_interval(config: dict[str, dict[str, str]], league: str) -> float:
+    """
+    Returns the interval from [daemon] <league>_interval or interval.
+    """
+    return _setting(
+        config, f"{league}_interval", _setting(config, "interval", DEFAULT_INTERVAL)
+    )
+
+
+def unchanged_streak(history: list[tuple[float, bool]]) -> int:
+    """
+    Returns the number of latest fetches that found no changes.
+    """
+    streak = 0
+    for _, changed in history:
+        if changed:
+            break
+        streak += 1
+    return streak
+
+
+def changes_per_day(history: list[tuple[float, bool]], now: float) -> float:
+    """
+    Returns how often the page changed over the last week of fetches.
+    """
+    recent = [
+        (fetched_at, changed)
+        for fetched_at, changed in history
+        if now - fetched_at <= HISTORY_WINDOW
+    ]
+    if len(recent) < 2:
+        return 0.0
+    # a few hours of history would make a single change look like a volatile schedule
+    span = max(now - recent[-1][0], 24 * 60 * 60)
+    return sum(changed for _, changed in recent) * 24 * 60 * 60 / span
+
+
+def upcoming_starts(url: str, now: float) -> list[float]:
+    """
+    Returns sorted start timestamps of the games cached from the last parse of the url.
+    """
+    events = p.http_cache.load_events(url, tag=None) or []
+    starts = []
+    for event in events:
+        start = p.parse_datetime(event.get("dateTime"))
+        if start is not None and start.timestamp() >= now:
+            starts.append(start.timestamp())
+    return sorted(starts)
+
+
+def plan_poll(
+    config: dict[str, dict[str, str]], league: str, now: float | None = None
+) -> PollPlan:
+    """
+    Picks when to poll the league next.
+
+    The interval starts at the configured one and doubles for every few fetches in a row
+    that found no changes, up to max_interval. It is kept at the configured one while the
+    page changes often, a game is close or the known games are running out, and drops to
+    min_interval right after a change.
+
+    Args:
+        config: urls.ini as a dict
+        league: league name
+        now: timestamp to plan from, current time by default
+
+    Returns:
+        PollPlan: the next poll time with the interval and the reason it was picked
+    """
+    if now is None:
+        now = time.time()
+    base = base_interval(config, league)
+    low = min(_setting(config, "min_interval", MIN_INTERVAL), base)
+    high = max(_setting(config, "max_interval", MAX_INTERVAL), base)
+
+    url = config.get("league_urls", {}).get(league)
+    history = p.http_cache.fetch_history(url) if url else []
+    starts = upcoming_starts(url, now) if url else []
+
+    streak = unchanged_streak(history)
+    interval = min(base * 2 ** (streak // BACKOFF_STEP), high)
+    reason = f"unchanged {streak} times"
+
+    last_change = next((fetched_at for fetched_at, changed in history if changed), None)
+    if last_change is not None and now - last_change < HOT_WINDOW:
+        interval, reason = low, "changed recently"
+    elif interval > base:
+        if changes_per_day(history, now) > VOLATILE_CHANGES_PER_DAY:
+            interval, reason = base, "schedule changes often"
+        elif starts and starts[0] - now < GAME_WINDOW:
+            interval, reason = base, "game within a day"
+        elif not starts or starts[-1] - now < ROUND_WINDOW:
+            interval, reason = base, "waiting for new games"
+
+    if starts:
+        # poll once more right before the next game in case it is moved at the last moment
+        before_game = starts[0] - low
+        if now < before_game < now + interval:
+            interval, reason = before_game - now, "right before a game"
+
+    return PollPlan(league, now + interval, interval, reason)
@@ -0,0 +1,371 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from logger import Logger
+
+logger = Logger(__name__)
+
+STATE_DB = "state.db"
+FETCH_HISTORY_DAYS = 30
+LEGACY_REJECTED_EVENTS_FILE = "rejected_events.json"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    body_hash TEXT,
+    body TEXT,
+    events TEXT,
+    events_hash TEXT
+);
+CREATE TABLE IF NOT EXISTS page_blocks (
+    url TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (url, fingerprint)
+);
+CREATE TABLE IF NOT EXISTS fetch_history (
+    url TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    changed INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fetch_history_url ON fetch_history (url, fetched_at);
+CREATE TABLE IF NOT EXISTS rejected_events (
+    key TEXT PRIMARY KEY,
+    event TEXT NOT NULL,
+    rejected_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS calendar_events (
+    calendar_id TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (calendar_id, event_id)
+);
+-- events inserted by the sync used to be recorded, nothing read them
+DROP TABLE IF EXISTS synced_events;
+CREATE TABLE IF NOT EXISTS match_reports (
+    url TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS prompts (
+    message_id TEXT PRIMARY KEY,
+    key TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    text TEXT NOT NULL,
+    sent_at REAL NOT NULL
+);
+"""
+
+
+class StateStore:
+    """
+    State kept between runs in a SQLite database in WAL mode: fetched pages and their blocks, rejected events,
+    the calendar mirror, match reports, pending Telegram prompts and small values
+    like sync tokens and cursors.
+
+    Every thread gets its own connection, writes go through transactions.
+    """
+
+    def __init__(self, path: str = STATE_DB):
+        self.path = path
+        self._local = threading.local()
+        # executescript commits on its own, so the schema is created outside of a transaction
+        self._conn().executescript(SCHEMA)
+        self._migrate_rejected_events()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _migrate_rejected_events(self):
+        # rejected events used to be kept in a JSON lines file
+        if not os.path.exists(LEGACY_REJECTED_EVENTS_FILE):
+            return
+        try:
+            with open(LEGACY_REJECTED_EVENTS_FILE, "r") as f:
+                events = [json.loads(line) for line in f if line.strip()]
+        except (OSError, ValueError) as e:
+            logger.error(f"Couldn't migrate rejected events: {e}")
+            return
+        self.add_rejected_events(events)
+        os.remove(LEGACY_REJECTED_EVENTS_FILE)
+        logger.info(f"Moved {len(events)} rejected events to {self.path}")
+
+    # small values
+
+    def get_value(self, key: str, default=None):
+        row = (
+            self._conn()
+            .execute("SELECT value FROM kv WHERE key = ?", (key,))
+            .fetchone()
+        )
+        return json.loads(row["value"]) if row else default
+
+    def set_value(self, key: str, value):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                (key, json.dumps(value, ensure_ascii=False)),
+            )
+
+    # fetched pages
+
+    def get_page(self, url: str) -> dict | None:
+        row = (
+            self._conn().execute("SELECT * FROM pages WHERE url = ?", (url,)).fetchone()
+        )
+        if row is None:
+            return None
+        page = dict(row)
+        page["events"] = json.loads(page["events"]) if page["events"] else None
+        return page
+
+    def put_page(self, url: str, page: dict):
+        events = page.get("events")
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO pages (url, etag, last_modified, body_hash, body, events,"
+                " events_hash) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    page.get("etag"),
+                    page.get("last_modified"),
+                    page.get("body_hash"),
+                    page.get("body"),
+                    (
+                        json.dumps(events, ensure_ascii=False)
+                        if events is not None
+                        else None
+                    ),
+                    page.get("events_hash"),
+                ),
+            )
+
+    def put_page_events(self, url: str, events: list[dict], events_hash: str):
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE pages SET events = ?, events_hash = ? WHERE url = ?",
+                (json.dumps(events, ensure_ascii=False), events_hash, url),
+            )
+
+    def get_page_blocks(self, url: str) -> dict[str, dict]:
+        rows = self._conn().execute(
+            "SELECT fingerprint, data FROM page_blocks WHERE url = ?", (url,)
+        )
+        return {row["fingerprint"]: json.loads(row["data"]) for row in rows}
+
+    def put_page_blocks(self, url: str, blocks: dict[str, dict]):
+        """
+        Replaces blocks kept for the url with the blocks of its last parse.
+        """
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM page_blocks WHERE url = ?", (url,))
+            conn.executemany(
+                "INSERT INTO page_blocks (url, fingerprint, data) VALUES (?, ?, ?)",
+                [
+                    (url, fingerprint, json.dumps(data, ensure_ascii=False))
+                    for fingerprint, data in blocks.items()
+                ],
+            )
+
+    def record_fetch(self, url: str, changed: bool):
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO fetch_history (url, fetched_at, changed) VALUES (?, ?, ?)",
+                (url, now, int(changed)),
+            )
+            conn.execute(
+                "DELETE FROM fetch_history WHERE url = ? AND fetched_at < ?",
+                (url, now - FETCH_HISTORY_DAYS * 24 * 60 * 60),
+            )
+
+    def fetch_history(self, url: str, limit: int = 100) -> list[tuple[float, bool]]:
+        """
+        Returns (fetched_at, changed) of the latest fetches of the url, newest first.
+        A fetch is changed when games were added to the page or removed from it.
+        """
+        rows = self._conn().execute(
+            "SELECT fetched_at, changed FROM fetch_history WHERE url = ?"
+            " ORDER BY fetched_at DESC LIMIT ?",
+            (url, limit),
+        )
+        return [(row["fetched_at"], bool(row["changed"])) for row in rows]
+
+    # rejected events
+
+    def rejected_events(self) -> list[dict]:
+        rows = self._conn().execute("SELECT event FROM rejected_events").fetchall()
+        return [json.loads(row["event"]) for row in rows]
+
+    def add_rejected_events(self, events: list[dict]):
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO rejected_events (key, event, rejected_at) VALUES (?, ?, ?)",
+                [
+                    (
+                        f"{event['dateTime']}|{event['teams']}",
+                        json.dumps(event, ensure_ascii=False),
+                        now,
+                    )
+                    for event in events
+                ],
+            )
+
+    def expire_rejected_events(self, max_age: float) -> int:
+        """
+        Forgets events rejected more than max_age seconds ago.
+
+        Returns:
+            int: number of forgotten events
+        """
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "DELETE FROM rejected_events WHERE rejected_at < ?",
+                (time.time() - max_age,),
+            )
+            return cursor.rowcount
+
+    # calendar mirror
+
+    def get_calendar_events(self, calendar_id: str) -> dict[str, dict]:
+        rows = self._conn().execute(
+            "SELECT event_id, data FROM calendar_events WHERE calendar_id = ?",
+            (calendar_id,),
+        )
+        return {row["event_id"]: json.loads(row["data"]) for row in rows}
+
+    def update_calendar_events(
+        self,
+        calendar_id: str,
+        changes: dict[str, dict | None],
+        sync_token: str | None,
+        full: bool = False,
+    ):
+        """
+        Applies changed events (None for removed ones) and the new sync token in one transaction.
+        A full sync replaces everything stored for the calendar.
+        """
+        with self.transaction() as conn:
+            if full:
+                conn.execute(
+                    "DELETE FROM calendar_events WHERE calendar_id = ?", (calendar_id,)
+                )
+            conn.executemany(
+                "DELETE FROM calendar_events WHERE calendar_id = ? AND event_id = ?",
+                [
+                    (calendar_id, event_id)
+                    for event_id, data in changes.items()
+                    if data is None
+                ],
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO calendar_events (calendar_id, event_id, data) VALUES (?, ?, ?)",
+                [
+                    (calendar_id, event_id, json.dumps(data, ensure_ascii=False))
+                    for event_id, data in changes.items()
+                    if data is not None
+                ],
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                (f"sync_token:{calendar_id}", json.dumps(sync_token)),
+            )
+
+    # reports of finished matches, they never change once the game is over
+
+    def get_match_reports(self, urls: list[str]) -> dict[str, dict]:
+        conn = self._conn()
+        reports = {}
+        for url in urls:
+            row = conn.execute(
+                "SELECT data FROM match_reports WHERE url = ?", (url,)
+            ).fetchone()
+            if row is not None:
+                reports[url] = json.loads(row["data"])
+        return reports
+
+    def put_match_reports(self, reports: dict[str, dict]):
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO match_reports (url, data, fetched_at) VALUES (?, ?, ?)",
+                [
+                    (url, json.dumps(data, ensure_ascii=False), now)
+                    for url, data in reports.items()
+                ],
+            )
+
+    # telegram prompts
+
+    def pending_prompts(self) -> dict[str, dict]:
+        rows = self._conn().execute("SELECT * FROM prompts").fetchall()
+        return {row["message_id"]: dict(row) for row in rows}
+
+    def add_prompts(self, prompts: list[dict]):
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO prompts (message_id, key, chat_id, text, sent_at)"
+                " VALUES (:message_id, :key, :chat_id, :text, :sent_at)",
+                [
+                    {**prompt, "message_id": str(prompt["message_id"])}
+                    for prompt in prompts
+                ],
+            )
+
+    def resolve_prompts(self, message_ids: list[str], offset: int | None):
+        """
+        Removes answered or expired prompts and moves the getUpdates cursor in one transaction.
+        """
+        with self.transaction() as conn:
+            conn.executemany(
+                "DELETE FROM prompts WHERE message_id = ?",
+                [(message_id,) for message_id in message_ids],
+            )
+            if offset is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO kv (key, value) VALUES ('telegram_offset', ?)",
+                    (json.dumps(offset),),
+                )
+
+
+_store: StateStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> StateStore:
+    """
+    Returns the state store of the process, opening it on first use.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = StateStore()
+        return _store
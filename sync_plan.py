@@ -0,0 +1,111 @@
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import timedelta
+from parser import Event
+from storage import get_store
+
+# vanished and new games of the same teams closer than this are treated as a reschedule
+MOVE_WINDOW = timedelta(days=14)
+
+
+@dataclass
+class SyncPlan:
+    """
+    Changes needed to bring the calendar in line with the parsed events.
+    """
+
+    to_insert: list[Event] = field(default_factory=list)
+    to_delete: list[tuple[Event, str]] = field(default_factory=list)
+    # (event in the calendar, its id, rescheduled event)
+    to_move: list[tuple[Event, str, Event]] = field(default_factory=list)
+
+
+def load_rejected_events() -> set[Event]:
+    """
+    Reads events the user declined to add.
+    """
+    return {Event(**event) for event in get_store().rejected_events()}
+
+
+def save_rejected_events(events: list[Event]):
+    if events:
+        get_store().add_rejected_events([event.to_json() for event in events])
+
+
+def build_plan(
+    parsed_events: list[Event],
+    calendar_events: dict[Event, str],
+    rejected_events: set[Event],
+    leagues: set[str],
+    unfetched: set[str] | None = None,
+) -> SyncPlan:
+    """
+    Diffs the parsed events of the leagues against the calendar events in one pass over each side.
+
+    Args:
+        parsed_events (list[Event]): events parsed from the league sites
+        calendar_events (dict[Event, str]): calendar events with their ids
+        rejected_events (set[Event]): events the user declined to add
+        leagues (set[str]): only events of these leagues are synced
+        unfetched (set[str]): leagues that couldn't be fetched, their calendar events are never deleted
+
+    Returns:
+        SyncPlan: events to insert, delete and move
+    """
+    plan = SyncPlan()
+    # dict keeps the order of the parsed events and drops duplicates
+    parsed = dict.fromkeys(event for event in parsed_events if event.league in leagues)
+    calendar = {event: (event, event_id) for event, event_id in calendar_events.items()}
+    for event in parsed:
+        if event in calendar:
+            calendar_event, event_id = calendar[event]
+            if calendar_event.arena != event.arena:
+                plan.to_move.append((calendar_event, event_id, event))
+        elif event not in rejected_events:
+            plan.to_insert.append(event)
+
+    unfetched = unfetched or set()
+    for event, event_id in calendar_events.items():
+        if (
+            event.league in leagues
+            and event.league not in unfetched
+            and event not in parsed
+        ):
+            plan.to_delete.append((event, event_id))
+
+    match_moves(plan)
+    return plan
+
+
+def match_moves(plan: SyncPlan):
+    """
+    Pairs vanished and new games of the same teams and league within MOVE_WINDOW
+    and turns every pair into a move.
+    """
+    if not plan.to_insert or not plan.to_delete:
+        return
+    vanished = defaultdict(list)
+    for event, event_id in plan.to_delete:
+        vanished[(event.teams, event.league)].append((event, event_id))
+
+    moved = set()
+    to_insert = []
+    for event in plan.to_insert:
+        candidates = [
+            (abs(old.start - event.start), old, event_id)
+            for old, event_id in vanished.get((event.teams, event.league), [])
+            if event_id not in moved
+            and old.start is not None
+            and event.start is not None
+            and abs(old.start - event.start) <= MOVE_WINDOW
+        ]
+        if not candidates:
+            to_insert.append(event)
+            continue
+        _, old, event_id = min(candidates, key=lambda candidate: candidate[0])
+        moved.add(event_id)
+        plan.to_move.append((old, event_id, event))
+    plan.to_insert = to_insert
+    plan.to_delete = [
+        (event, event_id) for event, event_id in plan.to_delete if event_id not in moved
+    ]
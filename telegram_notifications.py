@@ -1,14 +1,77 @@
 import requests
 import re
+import threading
 import time
+from typing import Callable
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from logger import Logger
-import configparser
+from config import get_config
+from storage import get_store
+import metrics
+import resilience
+from urllib.parse import urlsplit
 
 logger = Logger(__name__)
-config = configparser.ConfigParser()
-config.read("urls.ini")
-TOKEN = config["telegram"]["token"]
-BASE_URL = f"https://api.telegram.org/bot{TOKEN}/"
+API_ROOT = "https://api.telegram.org"
+API_HOST = urlsplit(API_ROOT).netloc
+
+# unanswered prompts are treated as confirmed after this many seconds, unless set in urls.ini
+CONFIRMATION_TIMEOUT = 60 * 60
+
+MESSAGE_LIMIT = 4096  # max length of a telegram message
+GLOBAL_RATE = 30  # messages per second the bot may send to all chats
+CHAT_INTERVAL = 1.0  # seconds between messages to the same chat
+SEND_RETRIES = 3
+MAX_SENDERS = 8
+
+# one keep-alive connection pool for every call to the bot API
+session = requests.Session()
+session.hooks["response"].append(metrics.response_hook("telegram"))
+
+
+class RateLimiter:
+    """
+    Lets through at most rate calls per period seconds, shared by all threads.
+    """
+
+    def __init__(self, rate: int, period: float = 1.0):
+        self.rate = rate
+        self.period = period
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.period:
+                    self._calls.popleft()
+                if len(self._calls) < self.rate:
+                    self._calls.append(now)
+                    return
+                delay = self._calls[0] + self.period - now
+            time.sleep(delay)
+
+
+global_limiter = RateLimiter(GLOBAL_RATE)
+_chat_limiters: dict[str, RateLimiter] = {}
+_chat_limiters_lock = threading.Lock()
+
+
+def chat_limiter(chat_id) -> RateLimiter:
+    """
+    Returns the limiter keeping messages to the chat CHAT_INTERVAL apart, shared by all threads.
+    """
+    with _chat_limiters_lock:
+        limiter = _chat_limiters.get(str(chat_id))
+        if limiter is None:
+            limiter = _chat_limiters[str(chat_id)] = RateLimiter(1, CHAT_INTERVAL)
+        return limiter
+
+
+def api_url(method: str) -> str:
+    return f"{API_ROOT}/bot{get_config()['telegram']['token']}/{method}"
 
 
 def reformat_with_markdown(text):
@@ -42,34 +105,153 @@ def send_notification(text: str, chat_id: str = None) -> bool:
         bool: True if notification was sent successfully, False otherwise
     """
     if chat_id is None:
-        chat_id = config["telegram"]["personal_chat_id"]
+        chat_id = get_config()["telegram"]["personal_chat_id"]
     text = reformat_with_markdown(text)
 
     payload = {"chat_id": chat_id, "text": text, "parse_mode": "Markdown"}
-    try:
-        response = requests.post(f"{BASE_URL}sendMessage", json=payload)
-    except Exception as e:
-        logger.error(f"Error sending notification: {e}")
-        return False
-    return response.status_code == 200
+    response = post_message(payload)
+    return response is not None and response.status_code == 200
 
 
-def ask_confirmation(text: str, chat_id: str = None) -> bool:
+@metrics.span("telegram")
+def post_message(payload: dict) -> requests.Response | None:
     """
-    Ask user for confirmation
-
-    Args:
-        text (str): Text to send
-        chat_id (str): Chat ID to send to, personal chat if default
+    Calls sendMessage within the rate limits of the chat and the bot. 429 answers are waited out for retry_after seconds,
+    5xx answers and network errors are retried with backoff, within the run deadline. Nothing is sent once it passed,
+    and a request cut short by it doesn't count as a failure of the API.
 
     Returns:
-        bool: True if user confirmed, False otherwise
+        requests.Response: last response of the API, None if the request failed
     """
-    if chat_id is None:
-        chat_id = config["telegram"]["personal_chat_id"]
-    text = reformat_with_markdown(text)
+    if not resilience.breaker.allow(API_HOST):
+        logger.error("Telegram keeps failing, notification not sent")
+        return None
+    retry = resilience.Retry(SEND_RETRIES)
+    while True:
+        chat_limiter(payload["chat_id"]).wait()
+        global_limiter.wait()
+        if resilience.remaining() == 0:
+            logger.error("Run deadline passed, notification not sent")
+            return None
+        try:
+            response = session.post(
+                api_url("sendMessage"), json=payload, timeout=retry.timeout(10)
+            )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            logger.warning(f"Error sending notification: {e}")
+            if retry.wait():
+                continue
+            if not retry.cut_short:
+                resilience.breaker.failure(API_HOST)
+            return None
+        except Exception as e:
+            logger.error(f"Error sending notification: {e}")
+            return None
+        if response.status_code not in resilience.RETRY_STATUSES:
+            resilience.breaker.success(API_HOST)
+            return response
+        delay = resilience.retry_after(response.headers.get("Retry-After"))
+        if response.status_code == 429:
+            try:
+                delay = response.json().get("parameters", {}).get("retry_after", delay)
+            except ValueError:
+                pass
+        if retry.wait(delay):
+            logger.warning(f"Telegram answered {response.status_code}, retrying")
+            continue
+        if response.status_code != 429:
+            resilience.breaker.failure(API_HOST)
+        return response
+
+
+def split_digest(texts: list[str]) -> list[str]:
+    """
+    Joins the texts into as few messages as fit into MESSAGE_LIMIT.
+    """
+    messages = []
+    current = ""
+    for text in texts:
+        while len(text) > MESSAGE_LIMIT:
+            if current:
+                messages.append(current)
+                current = ""
+            messages.append(text[:MESSAGE_LIMIT])
+            text = text[MESSAGE_LIMIT:]
+        if current and len(current) + 2 + len(text) > MESSAGE_LIMIT:
+            messages.append(current)
+            current = ""
+        current = f"{current}\n\n{text}" if current else text
+    if current:
+        messages.append(current)
+    return messages
+
+
+class Notifier:
+    """
+    Collects notifications of a run and sends every chat a single digest.
+    Chats are sent to concurrently within the per-chat and global rate limits.
+    """
+
+    def __init__(self):
+        self._messages: dict[str, list[str]] = {}
+        self._calls: list[tuple[Callable, tuple]] = []
+        self._lock = threading.Lock()
+
+    def add(self, text: str, chat_id: str = None):
+        """
+        Queues the notification, personal chat if chat_id is not given. Duplicates are sent once.
+        """
+        if chat_id is None:
+            chat_id = get_config()["telegram"]["personal_chat_id"]
+        text = reformat_with_markdown(text)
+        with self._lock:
+            messages = self._messages.setdefault(chat_id.strip(), [])
+            if text not in messages:
+                messages.append(text)
 
-    keyboard = {
+    def defer(self, call: Callable, *args):
+        """
+        Queues a call to the bot API that nothing waits for, it is made by flush along with the digests.
+        """
+        with self._lock:
+            self._calls.append((call, args))
+
+    def _send_chat(self, chat_id: str, texts: list[str]) -> bool:
+        ok = True
+        for text in split_digest(texts):
+            response = post_message(
+                {"chat_id": chat_id, "text": text, "parse_mode": "Markdown"}
+            )
+            if response is None or response.status_code != 200:
+                logger.error(
+                    f"Couldn't send notification to {chat_id}: {response.text if response is not None else ''}"
+                )
+                ok = False
+        return ok
+
+    def flush(self) -> bool:
+        """
+        Sends the queued notifications.
+
+        Returns:
+            bool: True if every digest was sent
+        """
+        with self._lock:
+            messages, self._messages = self._messages, {}
+            calls, self._calls = self._calls, []
+        if not messages and not calls:
+            return True
+        with ThreadPoolExecutor(
+            max_workers=min(len(messages) + len(calls), MAX_SENDERS)
+        ) as pool:
+            for call, args in calls:
+                pool.submit(call, *args)
+            results = list(pool.map(self._send_chat, messages, messages.values()))
+        return all(results)
+
+
+def _confirmation_keyboard() -> dict:
+    return {
         "inline_keyboard": [
             [
                 {"text": "Yes", "callback_data": "confirm_yes"},
@@ -78,84 +260,155 @@ def ask_confirmation(text: str, chat_id: str = None) -> bool:
         ]
     }
 
-    payload = {
-        "chat_id": chat_id,
-        "text": text,
+
+def _close_prompt(prompt: dict, status_text: str):
+    edit_payload = {
+        "chat_id": prompt["chat_id"],
+        "message_id": prompt["message_id"],
+        "text": f"{prompt['text']}\n\n{status_text}",
         "parse_mode": "Markdown",
-        "reply_markup": keyboard,
     }
+    global_limiter.wait()
+    try:
+        session.post(api_url("editMessageText"), json=edit_payload, timeout=10)
+    except Exception as e:
+        logger.error(f"Error editing message: {e}")
+
 
+def _answer_prompt(callback_query_id: str, prompt: dict, status_text: str):
+    # answers to callback queries are not messages and don't count against the global limit
     try:
-        response = requests.post(f"{BASE_URL}sendMessage", json=payload)
+        session.post(
+            api_url("answerCallbackQuery"),
+            json={"callback_query_id": callback_query_id},
+            timeout=10,
+        )
     except Exception as e:
-        logger.error(f"Error sending message: {e}")
-        return False
-    if response.status_code != 200:
-        logger.error(f"Failed to send message: {response.text}")
-        return False
-
-    message_id = response.json().get("result", {}).get("message_id")
-    if not message_id:
-        return False
-
-    # Polling for response
-    last_update_id = -1
-    start_time = time.time()
-    timeout = 60  # 60 seconds timeout
-
-    while time.time() - start_time < timeout:
-        params = {"offset": last_update_id + 1, "timeout": 10}
+        logger.error(f"Error answering callback: {e}")
+    _close_prompt(prompt, status_text)
+
+
+def request_confirmations(prompts: dict[str, str], chat_id: str = None) -> list[str]:
+    """
+    Sends a Yes/No prompt for every key that has no prompt waiting for an answer yet.
+    Doesn't wait for the answers, they are picked up by collect_confirmations.
+
+    Args:
+        prompts (dict[str, str]): texts to send by their keys
+        chat_id (str): Chat ID to send to, personal chat if default
+
+    Returns:
+        list[str]: keys of the prompts sent now
+    """
+    if chat_id is None:
+        chat_id = get_config()["telegram"]["personal_chat_id"]
+    store = get_store()
+    waiting = {prompt["key"] for prompt in store.pending_prompts().values()}
+
+    sent = []
+    new_prompts = []
+    for key, text in prompts.items():
+        if key in waiting:
+            continue
+        text = reformat_with_markdown(text)
+        payload = {
+            "chat_id": chat_id,
+            "text": text,
+            "parse_mode": "Markdown",
+            "reply_markup": _confirmation_keyboard(),
+        }
+        response = post_message(payload)
+        if response is None:
+            continue
+        if response.status_code != 200:
+            logger.error(f"Failed to send message: {response.text}")
+            continue
+        message_id = response.json().get("result", {}).get("message_id")
+        if not message_id:
+            continue
+        new_prompts.append(
+            {
+                "key": key,
+                "chat_id": chat_id,
+                "message_id": message_id,
+                "text": text,
+                "sent_at": time.time(),
+            }
+        )
+        sent.append(key)
+    store.add_prompts(new_prompts)
+    return sent
+
+
+@metrics.span("telegram")
+def collect_confirmations(
+    timeout: int = 0, notifier: Notifier | None = None
+) -> dict[str, bool]:
+    """
+    Reads the answers to the prompts sent by request_confirmations.
+
+    Uses one getUpdates cursor shared by all prompts and persisted between runs,
+    so answers given after a run ended are applied by the next one.
+    Prompts left without an answer for CONFIRMATION_TIMEOUT seconds count as confirmed.
+
+    Args:
+        timeout (int): seconds to long-poll for new updates, 0 to only read what is already there
+        notifier (Notifier): notifier of the run, answered prompts are then closed when it is flushed
+            instead of before this returns
+
+    Returns:
+        dict[str, bool]: answers by the keys of their prompts
+    """
+    confirmation_timeout = get_config()["telegram"].getint(
+        "confirmation_timeout", CONFIRMATION_TIMEOUT
+    )
+    defer = notifier.defer if notifier is not None else lambda call, *args: call(*args)
+    store = get_store()
+    pending = store.pending_prompts()
+    offset = store.get_value("telegram_offset", 0)
+    resolved = []
+    answers = {}
+    while pending:
+        params = {"offset": offset, "timeout": timeout}
         try:
-            updates_resp = requests.get(
-                f"{BASE_URL}getUpdates", params=params, timeout=12
+            updates_resp = session.get(
+                api_url("getUpdates"), params=params, timeout=timeout + 10
             )
-            if updates_resp.status_code == 200:
-                updates = updates_resp.json().get("result", [])
-                for update in updates:
-                    last_update_id = update["update_id"]
-                    if "callback_query" in update:
-                        cb = update["callback_query"]
-                        if cb.get("message", {}).get("message_id") == message_id:
-                            data = cb.get("data")
-                            user_response = data == "confirm_yes"
-
-                            # Acknowledge callback
-                            requests.post(
-                                f"{BASE_URL}answerCallbackQuery",
-                                json={"callback_query_id": cb["id"]},
-                            )
-
-                            # Update message to reflect choice
-                            status_text = (
-                                "✅ *Подтверждено*"
-                                if user_response
-                                else "❌ *Отменено*"
-                            )
-                            edit_payload = {
-                                "chat_id": chat_id,
-                                "message_id": message_id,
-                                "text": f"{text}\n\n{status_text}",
-                                "parse_mode": "Markdown",
-                            }
-                            requests.post(
-                                f"{BASE_URL}editMessageText", json=edit_payload
-                            )
-
-                            return user_response
         except Exception as e:
             logger.error(f"Error polling Telegram updates: {e}")
+            break
+        if updates_resp.status_code != 200:
+            logger.error(f"Failed to get updates: {updates_resp.text}")
+            break
+        updates = updates_resp.json().get("result", [])
+        if not updates:
+            break
+        for update in updates:
+            offset = update["update_id"] + 1
+            cb = update.get("callback_query")
+            if not cb:
+                continue
+            message_id = str(cb.get("message", {}).get("message_id"))
+            prompt = pending.pop(message_id, None)
+            if prompt is None:
+                continue
+            resolved.append(message_id)
+            user_response = cb.get("data") == "confirm_yes"
+            answers[prompt["key"]] = user_response
+            defer(
+                _answer_prompt,
+                cb["id"],
+                prompt,
+                "✅ *Подтверждено*" if user_response else "❌ *Отменено*",
+            )
+        # later polls only pick up what is already queued
+        timeout = 0
 
-        time.sleep(1)
-
-    # Timeout - clean up keyboard
-    edit_payload = {
-        "chat_id": chat_id,
-        "message_id": message_id,
-        "text": f"{text}\n\nTimeout (No response)",
-        "parse_mode": "Markdown",
-    }
-    try:
-        requests.post(f"{BASE_URL}editMessageText", json=edit_payload)
-    except Exception as e:
-        logger.error(f"Error editing message: {e}")
-    return True
+    for message_id, prompt in list(pending.items()):
+        if time.time() - prompt["sent_at"] > confirmation_timeout:
+            pending.pop(message_id)
+            resolved.append(message_id)
+            answers[prompt["key"]] = True
+            defer(_close_prompt, prompt, "Timeout (No response)")
+    store.resolve_prompts(resolved, offset)
+    return answers
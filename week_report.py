@@ -1,64 +1,138 @@
 import requests
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from telegram_notifications import send_notification
-import configparser
+from config import get_config
 import re
 from logger import Logger
+from parser import DEFAULT_TIMEOUT, HTML_FEATURES, fetch_html, get_session
+from storage import get_store
 
 logger = Logger(__name__)
 
-config = configparser.ConfigParser()
-config.read("urls.ini")
-list_url = config["league_urls"]["LHL"]
-base_url = re.match(r"(https?://[^/]+)", list_url).group(1)
+REPORT_DAYS = 7
+# match pages fetched at once, as many as the connection pool of a requests session keeps
+MATCH_WORKERS = 10
 
 
-def get_match_info(url: str) -> str:
+def parse_match_info(html_content: str) -> dict:
+    """
+    Parses teams, score and the best player of each team from the match report page.
+    """
+    soup = BeautifulSoup(html_content, HTML_FEATURES)
+
+    team1, team2 = soup.find_all("p", class_="report-nameteam")
+    score = soup.find("p", class_="result").text
+    best_players = soup.find_all("table", class_="text-left table broadcasting4")[:2]
+
+    best_players_list = []
+    for player in best_players:
+        rows = player.find_all("tr")
+        pl = rows[1].find_all("td") if len(rows) > 1 else None
+        best_players_list.append(f"{pl[0].text} {pl[1].text}" if pl else None)
+    best_players_list += [None] * (2 - len(best_players_list))
+
+    return {
+        "team1": team1.text,
+        "team2": team2.text,
+        "score": score,
+        "stars": best_players_list,
+    }
+
+
+def render_match(info: dict) -> str:
+    lines = [f"{info['team1']} {info['score']} {info['team2']}", "Звезды матча:"]
+    for star, team in zip(info["stars"], (info["team1"], info["team2"])):
+        # a team without a best player has no line
+        if star:
+            lines.append(f"{star} {team}")
+    return "\n".join(lines)
+
+
+def fetch_match_info(url: str) -> dict | None:
     try:
-        req = requests.get(url)
-        soup = BeautifulSoup(req.text, "html.parser")
-
-        team1, team2 = soup.find_all("p", class_="report-nameteam")
-        score = soup.find("p", class_="result").text
-        best_players = soup.find_all("table", class_="text-left table broadcasting4")[
-            :2
-        ]
-
-        best_players_list = []
-        for player in best_players:
-            pl = (
-                player.find_all("tr")[1].find_all("td")
-                if len(player.find_all("tr")) > 1
-                else None
-            )
-            pl_name, pl_score = pl[0].text if pl else None, pl[1].text if pl else None
-            best_players_list.append(f"{pl_name} {pl_score}")
-    except Exception as e:
-        logger.error(f"Coudn't fetch match'es info: {e}")
-
-    return f"{team1.text} {score} {team2.text}\nЗвезды матча:\n{best_players_list[0] + ' ' + team1.text if best_players_list[0] else '-'}\n{best_players_list[1] + ' ' + team2.text if best_players_list[1] else '-'}"
-
-
-try:
-    req = requests.get(list_url)
-except Exception as e:
-    logger.error(f"{list_url} unavailible. {e}")
-soup = BeautifulSoup(req.text, "html.parser")
-event_elements = soup.find("tbody").find_all("tr")
-
-match_stats = []
-for event in event_elements:
-    info = event.find_all("td")
-    date = info[0].text[:-5]
-    link = info[-2].find("a").get("href") if info[-2].find("a") else None
-    if link and datetime.strptime(date, "%d.%m.%Y") > datetime.now() - timedelta(
-        days=7
-    ):
-        match_stats.append(get_match_info(base_url + link))
-
-send_notification(
-    f"Результаты недели {(datetime.now() - timedelta(days=7)).strftime('%d.%m')} - {datetime.now().strftime('%d.%m')}:\n\n"
-    + "\n\n".join(match_stats),
-    chat_id=config["telegram"]["lhl_sec_chat_id"],
-)
+        response = get_session(url).get(url, timeout=DEFAULT_TIMEOUT)
+        response.raise_for_status()
+        return parse_match_info(response.text)
+    except (requests.RequestException, ValueError, AttributeError) as e:
+        logger.error(f"Coudn't fetch match'es info {url}: {e}")
+        return None
+
+
+def recent_match_links(html_content: str, base_url: str, since: datetime) -> list[str]:
+    """
+    Returns report urls of the matches played since the given time, in the order of the list.
+    """
+    soup = BeautifulSoup(html_content, HTML_FEATURES)
+    table = soup.find("tbody")
+    links = []
+    for event in table.find_all("tr") if table else []:
+        info = event.find_all("td")
+        date = info[0].text[:-5]
+        link = info[-2].find("a").get("href") if info[-2].find("a") else None
+        if link and datetime.strptime(date.strip(), "%d.%m.%Y") > since:
+            links.append(base_url + link)
+    return links
+
+
+def match_reports(urls: list[str]) -> dict[str, dict]:
+    """
+    Returns reports of the matches by their urls. Reports of finished games never change,
+    so only the ones missing from the store are fetched, concurrently, and stored for good.
+    """
+    store = get_store()
+    reports = store.get_match_reports(urls)
+    missing = [url for url in urls if url not in reports]
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(len(missing), MATCH_WORKERS)) as pool:
+            fetched = {
+                url: info
+                for url, info in zip(missing, pool.map(fetch_match_info, missing))
+                if info is not None
+            }
+        store.put_match_reports(fetched)
+        reports.update(fetched)
+    logger.info(
+        f"{len(urls) - len(missing)} match reports cached, {len(missing)} fetched"
+    )
+    return reports
+
+
+def build_report(now: datetime | None = None) -> str | None:
+    """
+    Builds the digest of the LHL matches of the last REPORT_DAYS days.
+
+    Returns:
+        str: text of the digest, None if the list of matches couldn't be fetched
+    """
+    if now is None:
+        now = datetime.now()
+    since = now - timedelta(days=REPORT_DAYS)
+    list_url = get_config()["league_urls"]["LHL"]
+    base_url = re.match(r"(https?://[^/]+)", list_url).group(1)
+
+    html_content = fetch_html(list_url)
+    if not html_content:
+        logger.error(f"{list_url} unavailible.")
+        return None
+    urls = recent_match_links(html_content, base_url, since)
+    reports = match_reports(urls)
+    match_stats = [render_match(reports[url]) for url in urls if url in reports]
+    return (
+        f"Результаты недели {since.strftime('%d.%m')} - {now.strftime('%d.%m')}:\n\n"
+        + "\n\n".join(match_stats)
+    )
+
+
+def send_report() -> bool:
+    report = build_report()
+    if report is None:
+        return False
+    return send_notification(
+        report, chat_id=get_config()["telegram"]["lhl_sec_chat_id"]
+    )
+
+
+if __name__ == "__main__":
+    send_report()